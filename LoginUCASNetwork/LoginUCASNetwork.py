@@ -12,6 +12,9 @@ from logging import debug as d
 
 logging.basicConfig(level=logging.DEBUG)
 
+# 网络请求的超时时间（秒），网关没有响应时不会一直卡住
+Timeout = 10
+
 # *************************** Helper ****************************
 
 
@@ -94,7 +97,7 @@ def login(userId, password):
                           **locals())
     # d(loginUrl)
     try:
-        fh = urlopen(loginUrl)
+        fh = urlopen(loginUrl, timeout=Timeout)
         # 不加下面的这句会出错
         time.sleep(0.1)
         html = fh.read().decode("utf8")
@@ -114,7 +117,7 @@ def getOnlineUserInfo(userIndex):
     try:
         success_url = str.format("http://210.77.16.21/eportal/InterFace.do?method=getOnlineUserInfo&userIndex={userIndex}",
                                  **locals())
-        result = urlopen(success_url).read().decode('utf8')
+        result = urlopen(success_url, timeout=Timeout).read().decode('utf8')
         if not result:
             return None
         result = json.loads(result)
@@ -155,7 +158,7 @@ def logout(userIndex=None):
     url = r'http://210.77.16.21/eportal/InterFace.do?method=logout&userIndex={}'.format(userIndex)
     # d(url)
     try:
-        urlopen(url)
+        urlopen(url, timeout=Timeout)
     except:
         pass
 
@@ -166,7 +169,7 @@ def logoutByUserIdAndPass(userId, password):
         userId, password)
     d(url)
     try:
-        urlopen(url)
+        urlopen(url, timeout=Timeout)
     except:
         pass
 
@@ -192,7 +195,7 @@ def isOnline():
     """检查当前是否在线"""
     patternString = "location.href='http://210.77.16.21:80"
     checkUrl = 'http://www.baidu.com'
-    with urlopen(checkUrl) as fh:
+    with urlopen(checkUrl, timeout=Timeout) as fh:
         data = fh.read().decode()
     if len(data) < 500 or patternString in data:
         return False
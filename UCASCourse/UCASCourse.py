@@ -6,35 +6,64 @@ import logging
 import re
 import time
 import json
+import sys
 from logging import debug
 import collections
+import collections.abc
 import tempfile
+import shutil
+import hashlib
+import calendar
+import email.utils
+import http.client
+import threading
+import contextlib
+import queue
+import heapq
+import itertools
+import urllib.parse
 from multiprocessing.dummy import Pool
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import urllib3.exceptions
+import lxml.html
 
 # logging.basicConfig(filename='UCAS.log', level=logging.DEBUG)
 
 # logging.basicConfig(level=logging.DEBUG)
 
 
-BeautifulSoupDefaultParser = 'lxml'
-
 # 链接信息
 LinkInfo = collections.namedtuple('LinkInfo', 'name url')
 # 文件信息
-FileInfo = collections.namedtuple('FileInfo', 'name url size')
+FileInfo = collections.namedtuple('FileInfo', 'name url size etag lastModified')
+FileInfo.__new__.__defaults__ = (None, None)
 # 下载任务
-DownloadTask = collections.namedtuple('DownloadTask', 'url localFile')
+DownloadTask = collections.namedtuple('DownloadTask', 'url localFile size')
+DownloadTask.__new__.__defaults__ = (None,)
 # 作业信息
 HomeworkInfo = collections.namedtuple('HomeworkInfo', 'name status openDate dueDate content attachment')
 
 
 class Course:
 
-    def __init__(self, session, courseName, courseUrl):
+    def __init__(self, session, courseName, courseUrl, metadata=None, toolUrlCache=None, homeworkCache=None,
+                 rosterCache=None):
+        """
+        args:
+            metadata: 课件元数据来源，多个课程可以共用一个
+            toolUrlCache: 按站点 ID 保存已解析的工具链接，多个课程可以共用一个
+            homeworkCache: 按作业详情链接保存已获取的作业，多个课程可以共用一个
+            rosterCache: 按站点 ID 保存已获取的学生名单，多个课程可以共用一个
+        """
         self.__session = session
+        self.__metadata = metadata or MetadataSource(session)
+        self.__toolUrlCache = toolUrlCache if toolUrlCache is not None else {}
+        self.__homeworkCache = homeworkCache if homeworkCache is not None else {}
+        self.__rosterCache = rosterCache if rosterCache is not None else {}
         self.__courseUrl = courseUrl
         self.__courseToolUrls = None
         self.__courseName = courseName
@@ -45,6 +74,11 @@ class Course:
     def session(self):
         return self.__session
 
+    @property
+    def metadata(self):
+        """课件元数据来源 MetadataSource"""
+        return self.__metadata
+
     @property
     def name(self):
         return self.__courseName
@@ -53,69 +87,103 @@ class Course:
     def url(self):
         return self.__courseUrl
 
+    @property
+    def siteId(self):
+        return self.url.split('/')[-1]
+
+    @property
+    def term(self):
+        """课程所在学期，见 parseCourseTerm"""
+        return parseCourseTerm(self.name)
+
     @property
     def courseToolUrls(self):
-        """获取课程的工具链接"""
-        if not self.__courseToolUrls:
-            self.__courseToolUrls = UCAS.getToolListUrls(self.session, self.session.get(self.url).text)
+        """获取课程的工具链接
+
+        只有用到的工具才会被解析，已经解析过的工具不再请求课程页面
+        """
+        if self.__courseToolUrls is None:
+            self.__courseToolUrls = ToolUrls(self.session, self.siteId, url=self.url, cache=self.__toolUrlCache)
         return self.__courseToolUrls
 
+    @property
+    def resourceUrl(self):
+        """课件目录的地址"""
+        return "http://course.ucas.ac.cn/access/content/group/{0}/".format(self.siteId)
+
     @property
     def resourceList(self):
         """获取课件列表"""
-
-        courseId = self.url.split('/')[-1]
-        resUrl = "http://course.ucas.ac.cn/access/content/group/{0}/".format(courseId)
-        return self.__getCourseResourceList(resUrl, directory=self.name)
+        return ResourceCrawler(self.session, metadata=self.metadata).crawl([(self.resourceUrl, self.name)])[0]
 
     @property
     def students(self):
-        """获取所有上课学生"""
+        """获取所有上课学生 [(学号, 姓名), ...]，rosterCache 中已有时不再请求"""
         if not self.__students:
-            url = self.courseToolUrls['应用统计']
-            html = self.session.get(url).text
-            table = BeautifulSoup(html, BeautifulSoupDefaultParser)('table')[1]
-
-            rList = []
-            for row in table('tr'):
-                tds = row('td')
-                if len(tds):
-                    rList.append((tds[1].text.strip(), tds[2].text.strip()))
-            self.__students = rList
+            students = self.__rosterCache.get(self.siteId)
+            if students is None:
+                url = self.courseToolUrls['应用统计']
+                students = parseStudents(self.session.get(url).text)
+                self.__rosterCache[self.siteId] = students
+            self.__students = [tuple(s) for s in students]
         return self.__students
 
     @property
     def homework(self):
         if not self.__homework:
-            url = self.courseToolUrls['课堂作业']
-            html = self.session.get(url).text
-            table = BeautifulSoup(html, BeautifulSoupDefaultParser).table
-
-            rList = []
-            if table:
-                for row in table('tr'):
-                    tds = row('td')
-                    if len(tds):
-                        status = tds[2].text.strip()
-                        openDate = tds[3].text.strip()
-                        dueDate = tds[4].text.strip()
-                        url = tds[1].a['href']
-                        detail = BeautifulSoup(self.session.get(url).text, BeautifulSoupDefaultParser)
-                        name = detail.find('table').td.text.strip()
-                        content = detail.find('div', class_='textPanel')
-                        content = content and content.text.strip()
-                        attachments = detail.find(class_='attachList') if '作业的附加资源' in detail.text else None
-                        attachments = attachments and [FileInfo(
-                            name=self.handleFileName(e.text.strip(), e['href']),
-                            url=e['href'],
-                            size=int(self.session.head(e['href']).headers.get('Content-Length'))
-                        ) for e in attachments('a')]
-
-                        rList.append(HomeworkInfo(name=name, status=status, openDate=openDate, dueDate=dueDate,
-                                                  content=content, attachment=attachments))
-            self.__homework = rList
+            self.__homework = [self.getHomeworkDetail(*row) for row in self.homeworkRows]
         return self.__homework
 
+    @property
+    def homeworkRows(self):
+        """作业列表，[(详情链接, 状态, 开始日期, 截止日期), ...]"""
+        return parseHomeworkList(self.session.get(self.courseToolUrls['课堂作业']).text)
+
+    def getHomeworkDetail(self, url, status, openDate, dueDate):
+        """获取作业详情
+
+        作业列表中这一行的状态和日期都没有变化时直接使用缓存，不再请求详情页和附件
+        """
+        row = [status, openDate, dueDate]
+        cached = self.__homeworkCache.get(url)
+        if cached and cached['row'] == row:
+            attachments = cached['attachment'] and [FileInfo(*x) for x in cached['attachment']]
+            return HomeworkInfo(name=cached['name'], status=status, openDate=openDate, dueDate=dueDate,
+                                content=cached['content'], attachment=attachments)
+
+        name, content, attachments = parseHomeworkDetail(self.session.get(url).text)
+        attachments = attachments and [
+            self.metadata.getFileInfo(self.handleFileName(e.name, e.url), e.url) for e in attachments]
+        self.__homeworkCache[url] = {'row': row, 'name': name, 'content': content,
+                                     'attachment': attachments and [list(x) for x in attachments]}
+        return HomeworkInfo(name=name, status=status, openDate=openDate, dueDate=dueDate,
+                            content=content, attachment=attachments)
+
+    @staticmethod
+    def getHomeworkOfCourses(courses, threadCount=4):
+        """并发获取多个课程的作业
+
+        先并发获取所有课程的作业列表，再把所有课程中需要更新的作业详情放在一起并发获取
+
+        return:
+            [(课程, [HomeworkInfo, ...]), ...]
+        """
+        if not courses:
+            return []
+        pool = Pool(threadCount)
+        try:
+            rowLists = pool.map(lambda c: c.homeworkRows, courses)
+            jobs = [(c, row) for c, rows in zip(courses, rowLists) for row in rows]
+            details = iter(pool.map(lambda job: job[0].getHomeworkDetail(*job[1]), jobs))
+        finally:
+            pool.close()
+            pool.join()
+        rList = []
+        for c, rows in zip(courses, rowLists):
+            c.__homework = [next(details) for _ in rows]
+            rList.append((c, c.__homework))
+        return rList
+
     @staticmethod
     def handleFileName(name, url):
         """处理文件名"""
@@ -138,94 +206,123 @@ class Course:
             s += urlExt
         return s
 
-    def __getCourseResourceList(self, resUrl, directory=None):
-        """获取课件列表
+    def getSyncResourceList(self, localDir, blackList=None, fileList=None, manifest=None):
+        """获取需要同步的课件列表
+
+        本地的课程目录只用 os.scandir 扫描一次，之后每个课件只需查一次字典
 
         args:
-            resUrl:
-                eg:
-                    http://course.ucas.ac.cn/access/content/group/117418/
-                    http://course.ucas.ac.cn/access/content/group/117418/%E8%AF%BE%E4%BB%B6/
-        """
-
-        # 列表第一项为当前目录名
-        fileList = [directory if directory else resUrl.split('/')[-1]]
-
-        html = self.session.get(resUrl).text
-        table = BeautifulSoup(html, BeautifulSoupDefaultParser).table
-
-        # 处理单个文件
-        resList = [LinkInfo(name=e.text.strip(), url=e['href']) for e in table('a') if not e['href'].endswith('/')]
-
-        # resList = list(set(resList))
-        files = []
-        for m in resList:
-            url = resUrl + m.url
-            r = self.session.head(url)
-            size = r.headers.get('Content-Length')
-            # 过滤文件名中的特殊字符： '\/:*?",.|'
-            name = self.handleFileName(m.name, m.url)
-            files.append(FileInfo(name=name, url=url, size=int(size)))
-
-        fileList += files
-
-        # resList = [x[:-1] if x.endswith(";") else x for x in resList]
-        # d(resList)
-
-        # 处理文件夹
-        folderList = [LinkInfo(name=e.text.strip(), url=e['href']) for e in table('a') if e['href'].endswith('/')]
-
-        # 删除 ..
-        folderList = [x for x in folderList if not x.url.startswith("..")]
-
-        for folder in folderList:
-            fl = self.__getCourseResourceList(resUrl + folder.url, directory=folder.name)
-            fileList.append(fl)
-        return fileList
-
-    def __walk(self, fileList, root=None):
-        """遍历文件列表，使用方法同 os.walk()"""
-        dirName = fileList[0]
-        root = os.path.join(root, dirName) if root else dirName
-        files = []
-        dirs = []
-        for f in fileList[1:]:
-            if not isinstance(f, list):
-                files.append(f)
-            else:
-                dirs.append(f)
-        yield (root, dirs, files)
-        for d in dirs:
-            yield next(self.__walk(d, root))
-
-    def getSyncResourceList(self, localDir, blackList=None):
-        """获取需要同步的课件列表"""
-        fileList = self.resourceList
+            blackList: 课件黑名单（正则表达式），匹配的文件和目录不同步
+            fileList: 已经抓取好的课件列表，为 None 时重新抓取（抓取时已经排除了黑名单中的文件和目录）
+            manifest: 同步清单 SyncManifest，用于发现大小相同但内容被替换的文件
+        """
+        if fileList is None:
+            fileList = ResourceCrawler(self.session, manifest=manifest, metadata=self.metadata,
+                                       blackList=blackList).crawl([(self.resourceUrl, self.name)])[0]
+            blackList = None
+        blackList = compileBlackList(blackList)
+        localIndex = scanLocalFiles(os.path.join(localDir, fileList[0]))
         rList = []
-        for root, dirs, files in self.__walk(fileList):
+        for root, dirs, files in walkFileList(fileList):
             root = os.path.join(localDir, root)
+            if blackList:
+                dirs[:] = [d for d in dirs if not isBlackListed(d[0], blackList)]
             for file in files:
+                if isBlackListed(file.name, blackList):
+                    continue
                 localFile = os.path.join(root, file.name)
-                if not os.path.isfile(localFile) or os.path.getsize(localFile) != file.size:
-                    rList.append(DownloadTask(url=file.url, localFile=localFile))
-        if blackList:
-            blackList = list(map(re.compile, blackList))
-            rList = [x for x in rList if all([not b.search(os.path.split(x.localFile)[1]) for b in blackList])]
+                if self.needSync(file, localFile, manifest, localIndex):
+                    rList.append(DownloadTask(url=file.url, localFile=localFile, size=file.size))
 
         return rList
 
     @staticmethod
-    def getSyncResourceListOfCourses(courses, localDir, resourceBlackList=None, threadCount=4):
-        """获取课程列表的同步课件列表"""
-        pool = Pool(threadCount)
-        rList = pool.map(lambda c: (c.name, c.getSyncResourceList(localDir, resourceBlackList)),
-                         courses)
-        pool.close()
-        pool.join()
+    def getSyncResourceListOfCourses(courses, localDir, resourceBlackList=None, threadCount=4, maxPerHost=4,
+                                     hostInterval=0, manifest=None):
+        """获取课程列表的同步课件列表，返回 [(课程名, [DownloadTask, ...]), ...]
+
+        所有课程的目录树由同一个 ResourceCrawler 一起并发抓取。抓取时不保存目录树，每得到一个文件就和本地文件比较
+        （见 iterSyncResourceListOfCourses），内存中只有需要下载的课件，同步所有学期时也不会保留所有课程的完整列表。
+        文件按抓取完成的顺序得到，每个课程的列表再按本地路径排序
+        """
+        tasks = collections.OrderedDict((c.name, []) for c in courses)
+        for name, task in Course.iterSyncResourceListOfCourses(courses, localDir, resourceBlackList, threadCount,
+                                                               maxPerHost, hostInterval, manifest):
+            tasks[name].append(task)
+        return [(name, sorted(rs, key=lambda task: task.localFile)) for name, rs in tasks.items() if rs]
+
+    @staticmethod
+    def iterSyncResourceListOfCourses(courses, localDir, resourceBlackList=None, threadCount=4, maxPerHost=4,
+                                      hostInterval=0, manifest=None, queueSize=64):
+        """边抓取边产生需要同步的课件 (courseName, DownloadTask)
 
-        rList = list(filter(lambda m: m[1], rList))
+        与 getSyncResourceListOfCourses 不同，不必等所有课程抓取完成，可以交给 downloadStream 边抓取边下载
+        """
+        if not courses:
+            return
+        crawler = ResourceCrawler(courses[0].session, threadCount, maxPerHost, hostInterval, manifest,
+                                  courses[0].metadata, resourceBlackList)
+        # 每个课程的本地目录在得到它的第一个文件时扫描
+        localIndexes = {}
+        try:
+            for rootIndex, path, file in crawler.iterate([(c.resourceUrl, c.name) for c in courses], queueSize):
+                localFile = os.path.join(localDir, *(path + (file.name,)))
+                if rootIndex not in localIndexes:
+                    localIndexes[rootIndex] = scanLocalFiles(os.path.join(localDir, path[0]))
+                if Course.needSync(file, localFile, manifest, localIndexes[rootIndex]):
+                    yield courses[rootIndex].name, DownloadTask(url=file.url, localFile=localFile, size=file.size)
+        finally:
+            if manifest:
+                manifest.save()
+
+    def getHomeworkSyncList(self, localDir, homework=None, manifest=None):
+        """获取需要同步的作业附件列表
+
+        附件保存在 localDir/课程名/课堂作业/作业名/ 下
+
+        args:
+            homework: 已经获取的作业列表，为 None 时使用 self.homework
+        """
+        homeworkDir = os.path.join(localDir, self.name, '课堂作业')
+        localIndex = scanLocalFiles(homeworkDir)
+        rList = []
+        for h in self.homework if homework is None else homework:
+            root = os.path.join(homeworkDir, self.handleFileName(h.name, ''))
+            for file in h.attachment or []:
+                localFile = os.path.join(root, file.name)
+                if self.needSync(file, localFile, manifest, localIndex):
+                    rList.append(DownloadTask(url=file.url, localFile=localFile, size=file.size))
         return rList
 
+    @staticmethod
+    def getHomeworkSyncListOfCourses(courses, localDir, threadCount=4, manifest=None):
+        """获取课程列表的作业附件同步列表，返回 [(课程名, [DownloadTask, ...]), ...]"""
+        rList = [(c.name, c.getHomeworkSyncList(localDir, homework, manifest))
+                 for c, homework in Course.getHomeworkOfCourses(courses, threadCount)]
+        if manifest:
+            manifest.save()
+        return [m for m in rList if m[1]]
+
+    @staticmethod
+    def needSync(file, localFile, manifest=None, localIndex=None):
+        """本地文件是否需要从服务器同步
+
+        args:
+            localIndex: scanLocalFiles 的结果，提供时不再逐个访问本地文件
+        """
+        if localIndex is None:
+            try:
+                stat = os.stat(localFile)
+            except OSError:
+                return True
+        else:
+            stat = localIndex.get(localFile)
+            if stat is None:
+                return True
+        if stat.st_size != file.size:
+            return True
+        return bool(manifest) and not manifest.isUpToDate(file, localFile, stat)
+
     def getMatchedStudents(self, idPattern=None, namePattern=None):
         """获取匹配学号模式和姓名模式的学生"""
         idPattern = idPattern and re.compile(idPattern)
@@ -234,14 +331,1504 @@ class Course:
                 (not namePattern or namePattern.search(s[1]))]
 
 
-class UCAS:
+class RosterIndex:
+    """多个课程学生名单的倒排索引 {学号: 选了的课程}
+
+    学号去掉空白并统一为小写，同一个学生在不同课程中只保存一次。
+    建好索引后查询只需遍历一次索引，不用再逐个课程匹配名单
+    """
+
+    def __init__(self, rosters):
+        """
+        args:
+            rosters: [(课程名, [(学号, 姓名), ...]), ...]
+        """
+        self.__courses = [course for course, _ in rosters]
+        # 学号 -> [姓名, [课程序号, ...]]
+        self.__students = {}
+        for i, (_, students) in enumerate(rosters):
+            for studentId, name in students:
+                entry = self.__students.setdefault(self.normalizeId(studentId), [name.strip(), []])
+                if entry[1][-1:] != [i]:
+                    entry[1].append(i)
+
+    @staticmethod
+    def normalizeId(studentId):
+        return studentId.strip().lower()
+
+    @staticmethod
+    def fromCourses(courses, threadCount=4):
+        """并发获取课程的学生名单并建立索引"""
+        if not courses:
+            return RosterIndex([])
+        pool = Pool(threadCount)
+        try:
+            rosters = pool.map(lambda c: (c.name, c.students), courses)
+        finally:
+            pool.close()
+            pool.join()
+        return RosterIndex(rosters)
+
+    def __len__(self):
+        return len(self.__students)
+
+    def __contains__(self, studentId):
+        return self.normalizeId(studentId) in self.__students
+
+    def coursesOf(self, studentId):
+        """学生选了的课程名"""
+        entry = self.__students.get(self.normalizeId(studentId))
+        return [self.__courses[i] for i in entry[1]] if entry else []
+
+    def studentsOf(self, courseName):
+        """选了某个课程的学生 [(学号, 姓名), ...]"""
+        if courseName not in self.__courses:
+            return []
+        i = self.__courses.index(courseName)
+        return [(studentId, name) for studentId, (name, courses) in self.__students.items() if i in courses]
+
+    def match(self, idPattern=None, namePattern=None):
+        """匹配学号模式和姓名模式的学生 [(学号, 姓名, [课程名, ...]), ...]，如某个班的所有学生"""
+        idPattern = idPattern and re.compile(idPattern)
+        namePattern = namePattern and re.compile(namePattern)
+        return [(studentId, name, [self.__courses[i] for i in courses])
+                for studentId, (name, courses) in self.__students.items()
+                if (not idPattern or idPattern.search(studentId)) and (not namePattern or namePattern.search(name))]
+
+    def classmates(self, studentId, minShared=1):
+        """和某个学生至少一起上 minShared 门课的同学，按共同课程数从多到少排列
+
+        return:
+            [(学号, 姓名, [共同的课程名, ...]), ...]
+        """
+        studentId = self.normalizeId(studentId)
+        entry = self.__students.get(studentId)
+        if not entry:
+            return []
+        mine = set(entry[1])
+        rList = []
+        for otherId, (name, courses) in self.__students.items():
+            shared = [self.__courses[i] for i in courses if i in mine]
+            if otherId != studentId and len(shared) >= minShared:
+                rList.append((otherId, name, shared))
+        rList.sort(key=lambda s: -len(s[2]))
+        return rList
+
+
+class ToolUrls(collections.abc.Mapping):
+    """站点左边工具栏中的工具链接 {工具名: 真实地址}
+
+    工具链接指向的页面中只有一个 iframe，真实地址需要再请求一次才能得到。
+    这里按需解析：只有用到的工具才会去请求，items()/values() 或 resolveAll() 会并发解析所有工具。
+    解析结果保存在按站点 ID 划分的 cache 中，cache 中已有的工具连站点页面都不用请求
+    """
+
+    def __init__(self, session, siteId, html=None, url=None, cache=None, threadCount=4, loader=None):
+        """
+        args:
+            html: 站点页面的内容或者已经解析好的页面
+            url: 站点页面的地址，没有提供 html 时在需要时请求
+            cache: {siteId: {'tools': {工具名: 真实地址}, 'complete': 是否已解析所有工具}}
+            loader: 获取站点页面的函数，页面不能直接用 url 请求时使用
+        """
+        self.__session = session
+        self.__html = html
+        self.__loader = loader or (lambda: session.get(url).text)
+        self.__threadCount = threadCount
+        self.__lock = threading.Lock()
+        self.__links = None
+        cache = cache if cache is not None else {}
+        self.__site = cache.setdefault(siteId, {'tools': {}, 'complete': False})
+
+    @property
+    def session(self):
+        return self.__session
+
+    def __getLinks(self):
+        """站点页面中的工具链接 {工具名: 链接}，只请求和解析一次"""
+        with self.__lock:
+            if self.__links is None:
+                html = self.__html if self.__html is not None else self.__loader()
+                self.__links = collections.OrderedDict((e.name, e.url) for e in parseToolLinks(html))
+                self.__html = None
+            return self.__links
+
+    def __getitem__(self, name):
+        url = self.__site['tools'].get(name)
+        if url is None:
+            links = self.__getLinks()
+            # loader 可能已经顺便解析出了一些工具
+            url = self.__site['tools'].get(name) or UCAS.getIFrameRealSrc(self.session, links[name])
+            self.__site['tools'][name] = url
+        return url
+
+    def __setitem__(self, name, url):
+        self.__site['tools'][name] = url
+
+    def __names(self):
+        if self.__site['complete']:
+            return list(self.__site['tools'])
+        names = list(self.__getLinks())
+        return names + [x for x in self.__site['tools'] if x not in self.__getLinks()]
+
+    def __iter__(self):
+        return iter(self.__names())
+
+    def __len__(self):
+        return len(self.__names())
+
+    def __contains__(self, name):
+        return name in self.__site['tools'] or name in self.__names()
+
+    def resolveAll(self):
+        """并发解析所有还没有解析的工具"""
+        if self.__site['complete']:
+            return
+        names = [x for x in self.__getLinks() if x not in self.__site['tools']]
+        if names:
+            pool = Pool(min(self.__threadCount, len(names)))
+            try:
+                pool.map(self.__getitem__, names)
+            finally:
+                pool.close()
+                pool.join()
+        self.__site['complete'] = True
+
+    def items(self):
+        self.resolveAll()
+        return super().items()
+
+    def values(self):
+        self.resolveAll()
+        return super().values()
+
+
+# 学期在一学年中的开始月份
+TermMonths = {'秋': 9, '春': 2, '夏': 7}
+
+
+def parseCourseTerm(name):
+    """从课程名中解析学期，如 "自然语言处理(16-17秋季)"
+
+    return:
+        (年份, 开始月份)，可以直接比较先后；课程名中没有学期时返回 None
+    """
+    m = re.search(r'(\d{2,4})(?:-(\d{2,4}))?([春夏秋])季', name)
+    if not m:
+        return None
+    year = int(m.group(1)) % 100
+    # 学年写法中春季和夏季学期属于后一年
+    if m.group(2) and m.group(3) != '秋':
+        year = int(m.group(2)) % 100
+    return year, TermMonths[m.group(3)]
+
+
+def walkFileList(fileList, root=None):
+    """遍历抓取得到的嵌套文件列表，使用方法同 os.walk()
+
+    用栈代替递归，按先序产生每一级目录的 (root, dirs, files)，所有子目录都会被访问到。
+    dirs 是该目录下的子目录列表，和 os.walk() 一样可以在循环中原地修改它来跳过某些子目录
+    """
+    pending = [(root, fileList)]
+    while pending:
+        parent, node = pending.pop()
+        path = os.path.join(parent, node[0]) if parent else node[0]
+        files = [f for f in node[1:] if not isinstance(f, list)]
+        dirs = [f for f in node[1:] if isinstance(f, list)]
+        yield path, dirs, files
+        # 倒序入栈，出栈时保持页面上的顺序
+        pending.extend((path, d) for d in reversed(dirs))
+
+
+def compileBlackList(blackList):
+    """编译黑名单中的正则表达式，已经编译过的保持不变"""
+    return [re.compile(b) if isinstance(b, str) else b for b in blackList or []]
+
+
+def isBlackListed(name, blackList):
+    return any(b.search(name) for b in blackList)
+
+
+def scanLocalFiles(directory):
+    """用 os.scandir 扫描目录树，返回 {文件路径: os.stat 结果}
+
+    文件路径与 os.path.join(directory, 子目录, ..., 文件名) 的结果相同，目录不存在时返回空字典
+    """
+    index = {}
+    pending = [directory]
+    while pending:
+        path = pending.pop()
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            continue
+        try:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        index[entry.path] = entry.stat()
+                except OSError:
+                    pass
+        finally:
+            # Python 3.5 的 scandir 迭代器没有 close，也不能用作上下文管理器
+            if hasattr(entries, 'close'):
+                entries.close()
+    return index
+
+
+class HostThrottle:
+    """按主机限制同时进行的请求数和请求间隔，避免对服务器造成过大压力"""
+
+    def __init__(self, maxPerHost=4, interval=0):
+        self.__maxPerHost = maxPerHost
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__semaphores = {}
+        self.__nextTime = {}
+
+    @contextlib.contextmanager
+    def hold(self, url):
+        """在 with 语句中占用一个到 url 所在主机的请求名额"""
+        host = urllib.parse.urlsplit(url).netloc
+        with self.__lock:
+            semaphore = self.__semaphores.get(host)
+            if not semaphore:
+                semaphore = self.__semaphores[host] = threading.BoundedSemaphore(self.__maxPerHost)
+        with semaphore:
+            if self.__interval:
+                with self.__lock:
+                    now = time.time()
+                    startTime = max(now, self.__nextTime.get(host, 0))
+                    self.__nextTime[host] = startTime + self.__interval
+                if startTime > now:
+                    time.sleep(startTime - now)
+            yield
+
+
+class ResourceCrawler:
+    """并发抓取课件目录树
+
+    目录列表的 GET 和文件的 HEAD 请求都放到同一个线程池中并发执行，线程数即全局同时进行的请求数上限，
+    另外每个主机的并发数和请求间隔由 HostThrottle 控制。
+    等待执行的请求按所属目录树在 roots 中的顺序排队，排在前面的目录树总是先抓取。
+    抓取结果与原来逐个请求得到的嵌套列表结构相同：[dirName, FileInfo, ..., [subDirName, ...], ...]
+    """
+
+    def __init__(self, session, threadCount=8, maxPerHost=4, hostInterval=0, manifest=None, metadata=None,
+                 blackList=None, listingCache=None):
+        """
+        args:
+            blackList: 课件黑名单（正则表达式），匹配的文件不获取信息，匹配的目录不进入
+            listingCache: 目录页面的缓存 ListingCache，提供时目录页面使用条件请求，没有变化的目录中的文件不再查询
+        """
+        self.__session = session
+        self.__threadCount = threadCount
+        self.__throttle = HostThrottle(maxPerHost, hostInterval)
+        self.__manifest = manifest
+        self.__metadata = metadata or MetadataSource(session)
+        self.__blackList = compileBlackList(blackList)
+        self.__listingCache = listingCache
+
+    @property
+    def session(self):
+        return self.__session
+
+    def crawl(self, roots, onFile=None, keepTree=True):
+        """抓取多个目录树
+
+        args:
+            roots: [(resUrl, directory), ...]，directory 为 None 时使用 url 中的目录名
+            onFile: 每得到一个文件的信息就在抓取线程中调用 onFile(rootIndex, dirPath, fileInfo)，
+                dirPath 为从根目录开始的各级目录名组成的元组
+            keepTree: 为 False 时不保存抓取结果，文件信息只交给 onFile，内存占用与文件总数无关
+        return:
+            与 roots 一一对应的文件列表，keepTree 为 False 时每个列表中只有目录名
+        """
+        results = [[directory if directory else resUrl.split('/')[-1]] for resUrl, directory in roots]
+        if not roots:
+            return results
+
+        pool = Pool(self.__threadCount)
+        condition = threading.Condition()
+        state = {'pending': 0, 'running': 0, 'error': None}
+        # 等待执行的请求 (rootIndex, 序号, func, args, onSuccess)，线程池中最多同时放 threadCount 个，
+        # 其余的留在堆中，这样后加入的靠前目录树的请求不会排在靠后目录树的请求之后
+        waiting = []
+        sequence = itertools.count()
+
+        def dispatch():
+            while True:
+                with condition:
+                    if state['error'] or not waiting or state['running'] >= self.__threadCount:
+                        return
+                    _, _, func, args, onSuccess = heapq.heappop(waiting)
+                    state['running'] += 1
+                pool.apply_async(func, args, callback=onSuccess, error_callback=fail)
+
+        def finish():
+            with condition:
+                state['pending'] -= 1
+                state['running'] -= 1
+                condition.notify_all()
+            dispatch()
+
+        def fail(e):
+            with condition:
+                state['error'] = state['error'] or e
+                # 出错后不再执行的请求也不再等待
+                state['pending'] -= 1 + len(waiting)
+                state['running'] -= 1
+                waiting.clear()
+                condition.notify_all()
+
+        def submit(rootIndex, func, args, callback):
+            def onSuccess(result):
+                try:
+                    callback(result)
+                except Exception as e:
+                    fail(e)
+                else:
+                    finish()
+
+            with condition:
+                if state['error']:
+                    return
+                state['pending'] += 1
+                heapq.heappush(waiting, (rootIndex, next(sequence), func, args, onSuccess))
+            dispatch()
+
+        def getFileInfo(rootIndex, path, resUrl, link, unchanged=False):
+            info = unchanged and self.__listingCache.getFile(resUrl + link.url)
+            if not info:
+                info = self.__getFileInfo(resUrl, link)
+                if self.__listingCache:
+                    self.__listingCache.setFile(info)
+            if onFile:
+                onFile(rootIndex, path, info)
+            return info
+
+        def onListing(rootIndex, path, resUrl, node):
+            def callback(listing):
+                files, folders, unchanged = listing
+                if self.__blackList:
+                    files = [m for m in files
+                             if not isBlackListed(Course.handleFileName(m.name, m.url), self.__blackList)]
+                    folders = [m for m in folders if not isBlackListed(m.name, self.__blackList)]
+                if node is None:
+                    for m in files:
+                        submit(rootIndex, getFileInfo, (rootIndex, path, resUrl, m, unchanged), lambda info: None)
+                else:
+                    # 先给文件占位，保证文件在子目录之前且顺序与页面一致
+                    offset = len(node)
+                    node.extend([None] * len(files))
+                    for i, m in enumerate(files):
+                        submit(rootIndex, getFileInfo, (rootIndex, path, resUrl, m, unchanged),
+                               lambda info, i=i: node.__setitem__(offset + i, info))
+                for folder in folders:
+                    child = [folder.name] if node is not None else None
+                    if child:
+                        node.append(child)
+                    submit(rootIndex, self.__getListing, (resUrl + folder.url,),
+                           onListing(rootIndex, path + (folder.name,), resUrl + folder.url, child))
+            return callback
+
+        for rootIndex, ((resUrl, directory), node) in enumerate(zip(roots, results)):
+            submit(rootIndex, self.__getListing, (resUrl,),
+                   onListing(rootIndex, (node[0],), resUrl, node if keepTree else None))
+
+        with condition:
+            while state['pending'] > 0:
+                condition.wait()
+        pool.close()
+        pool.join()
+        if state['error']:
+            raise state['error']
+        return results
+
+    def iterate(self, roots, queueSize=64):
+        """边抓取边返回文件
+
+        抓取在后台线程中进行，每得到一个文件就产生 (rootIndex, dirPath, fileInfo)。
+        文件经过一个长度为 queueSize 的队列交给调用者，队列满时抓取线程会等待，
+        所以消费者处理得慢时不会无限制地积压。提前关闭生成器会取消抓取
+        """
+        items = queue.Queue(queueSize)
+        stopped = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise CrawlCancelledException()
+
+        def run():
+            error = None
+            try:
+                self.crawl(roots, lambda *item: put(item), keepTree=False)
+            except CrawlCancelledException:
+                return
+            except Exception as e:
+                error = e
+            try:
+                put((end, error))
+            except CrawlCancelledException:
+                pass
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item[0] is end:
+                    if item[1]:
+                        raise item[1]
+                    return
+                yield item
+        finally:
+            stopped.set()
+            thread.join()
+
+    def __getListing(self, resUrl):
+        """获取目录页面中的文件链接和子目录链接，以及目录是否与上次抓取时相同"""
+        cache = self.__listingCache
+        with self.__throttle.hold(resUrl):
+            r = self.session.getHedged(resUrl, headers=cache and cache.conditionalHeaders(resUrl))
+        if cache:
+            return cache.update(resUrl, r)
+        return parseListing(r.text) + (False,)
+
+    def __getFileInfo(self, resUrl, link):
+        """获取单个文件的信息
+
+        优先使用 MetadataSource 批量取得的大小和修改时间；取不到时才发送 HEAD 请求，
+        此时同步清单中有记录的文件使用条件请求，服务器返回 304 时直接使用清单中的信息。
+        在清单的信任期内检查过的文件不再发送请求
+        """
+        url = resUrl + link.url
+        # 过滤文件名中的特殊字符： '\/:*?",.|'
+        name = Course.handleFileName(link.name, link.url)
+        entry = self.__manifest and self.__manifest.get(url)
+        if entry and self.__manifest.isTrusted(entry):
+            return FileInfo(name=name, url=url, size=entry['size'], etag=entry['etag'],
+                            lastModified=entry['lastModified'])
+
+        fileInfo = self.__metadata.lookup(name, url)
+        if fileInfo:
+            return fileInfo
+
+        headers = SyncManifest.conditionalHeaders(entry)
+        with self.__throttle.hold(url):
+            r = self.__metadata.head(url, headers)
+        if entry and r.status_code == 304:
+            self.__manifest.touch(url)
+            return FileInfo(name=name, url=url, size=entry['size'], etag=entry['etag'],
+                            lastModified=entry['lastModified'])
+        return FileInfo(name=name, url=url, size=int(r.headers.get('Content-Length')),
+                        etag=r.headers.get('ETag'), lastModified=r.headers.get('Last-Modified'))
+
+
+class MetadataSource:
+    """批量获取课件的元数据
+
+    通过 Sakai 的 content 接口 /direct/content/site/<siteId>.json 一次取得整个课程站点中
+    所有文件的大小和修改时间，能取到的文件就不用再逐个发送 HEAD 请求，HEAD 只作为后备。
+    avoidedHeads 和 sentHeads 分别记录省掉和实际发送的 HEAD 请求数
+    """
+
+    siteIdPattern = re.compile(r'/access/content/group/([^/]+)/')
+
+    def __init__(self, session, enabled=True):
+        self.__session = session
+        self.__enabled = enabled
+        self.__lock = threading.Lock()
+        self.__siteLocks = {}
+        self.__sites = {}
+        self.__avoidedHeads = 0
+        self.__sentHeads = 0
+
+    @property
+    def session(self):
+        return self.__session
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return {'avoidedHeads': self.__avoidedHeads, 'sentHeads': self.__sentHeads}
+
+    def lookup(self, name, url):
+        """从批量元数据中查找文件，找不到时返回 None"""
+        matched = self.__enabled and self.siteIdPattern.search(url)
+        if not matched:
+            return None
+        site = self.__getSite(url[:matched.start()], matched.group(1))
+        meta = site and site.get(urllib.parse.unquote(url))
+        if not meta:
+            return None
+        with self.__lock:
+            self.__avoidedHeads += 1
+        return FileInfo(name=name, url=url, size=meta[0], lastModified=meta[1])
+
+    def head(self, url, headers=None):
+        """发送 HEAD 请求并计数"""
+        with self.__lock:
+            self.__sentHeads += 1
+        return self.session.head(url, headers=headers)
+
+    def getFileInfo(self, name, url):
+        """获取文件信息，批量元数据中没有时发送 HEAD 请求"""
+        fileInfo = self.lookup(name, url)
+        if fileInfo:
+            return fileInfo
+        r = self.head(url)
+        return FileInfo(name=name, url=url, size=int(r.headers.get('Content-Length')),
+                        etag=r.headers.get('ETag'), lastModified=r.headers.get('Last-Modified'))
+
+    def __getSite(self, baseUrl, siteId):
+        """获取站点中所有文件的元数据 {url: (size, lastModified)}，每个站点只请求一次"""
+        with self.__lock:
+            if siteId in self.__sites:
+                return self.__sites[siteId]
+            siteLock = self.__siteLocks.setdefault(siteId, threading.Lock())
+        with siteLock:
+            with self.__lock:
+                if siteId in self.__sites:
+                    return self.__sites[siteId]
+            site = None
+            try:
+                r = self.session.get('{}/direct/content/site/{}.json'.format(baseUrl, siteId))
+                if r.ok:
+                    site = {}
+                    for e in r.json().get('content_collection', []):
+                        if e.get('url') and e.get('size') is not None and not e['url'].endswith('/'):
+                            site[urllib.parse.unquote(e['url'])] = (int(e['size']),
+                                                                    self.httpDate(e.get('modifiedDate')))
+            except ValueError:
+                site = None
+            debug('站点 %s 的批量元数据: %s' % (siteId, 'None' if site is None else len(site)))
+            with self.__lock:
+                self.__sites[siteId] = site
+            return site
+
+    @staticmethod
+    def httpDate(sakaiTime):
+        """把 Sakai 的时间（GMT，yyyyMMddHHmmssSSS）转换成与 Last-Modified 头相同的格式"""
+        try:
+            t = time.strptime(sakaiTime[:14], '%Y%m%d%H%M%S')
+        except (TypeError, ValueError):
+            return None
+        return email.utils.formatdate(calendar.timegm(t), usegmt=True)
+
+
+class SyncManifest:
+    """同步清单
+
+    以 url 为键记录每个已同步文件的大小、ETag/Last-Modified 和本地文件的大小与修改时间，
+    保存在同步目录下的 .ucas_manifest.json 中。
+    之后的同步可以据此发送条件请求，并能发现被替换成相同大小的新文件
+    """
+
+    fileName = '.ucas_manifest.json'
+
+    def __init__(self, localDir, trustTime=0):
+        """
+        args:
+            localDir: 同步目录
+            trustTime: 清单记录在检查后的多少秒内被直接信任，不再向服务器确认
+        """
+        self.__localDir = localDir
+        self.__path = os.path.join(localDir, self.fileName)
+        self.__trustTime = trustTime
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__changed = False
+        if os.path.isfile(self.__path):
+            try:
+                with open(self.__path, encoding='utf8') as fh:
+                    self.__entries = json.load(fh)
+            except ValueError:
+                debug('同步清单已损坏，重新建立: %s' % self.__path)
+
+    def get(self, url):
+        with self.__lock:
+            return self.__entries.get(url)
+
+    def isTrusted(self, entry):
+        """记录是否仍在信任期内"""
+        return self.__trustTime > 0 and time.time() - entry.get('checked', 0) < self.__trustTime
+
+    def touch(self, url):
+        """记录服务器已确认该文件未改变"""
+        with self.__lock:
+            if url in self.__entries:
+                self.__entries[url]['checked'] = time.time()
+                self.__changed = True
+
+    @staticmethod
+    def conditionalHeaders(entry):
+        """根据清单记录生成条件请求头"""
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+        return headers
+
+    def isUpToDate(self, fileInfo, localFile, stat=None):
+        """本地文件是否与服务器上的文件一致
+
+        本地文件与清单记录一致时比较服务器的校验信息；
+        没有记录（如清单建立之前下载的文件）时以大小为准并补充记录
+
+        args:
+            stat: 本地文件的 os.stat 结果，已经有时不再重复获取
+        """
+        if stat is None:
+            try:
+                stat = os.stat(localFile)
+            except OSError:
+                return False
+        entry = self.get(fileInfo.url)
+        if not entry:
+            if stat.st_size != fileInfo.size:
+                return False
+            self.update(fileInfo.url, localFile, fileInfo.size, fileInfo.etag, fileInfo.lastModified)
+            return True
+        if stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+            # 本地文件在清单之外被修改过，只能以大小为准
+            return stat.st_size == fileInfo.size
+        # 批量元数据中没有 ETag，只能比较双方都有的校验信息
+        if fileInfo.etag and entry['etag']:
+            return fileInfo.etag == entry['etag']
+        if fileInfo.lastModified and entry['lastModified']:
+            return fileInfo.lastModified == entry['lastModified']
+        return True
+
+    def update(self, url, localFile, size=None, etag=None, lastModified=None):
+        """记录一个已同步的文件"""
+        stat = os.stat(localFile)
+        with self.__lock:
+            self.__entries[url] = {
+                'file': os.path.relpath(localFile, self.__localDir),
+                'size': size if size is not None else stat.st_size,
+                'etag': etag,
+                'lastModified': lastModified,
+                'mtime': stat.st_mtime,
+                'checked': time.time(),
+            }
+            self.__changed = True
+
+    def save(self):
+        """保存清单，先写临时文件再替换以免中断时损坏"""
+        with self.__lock:
+            if not self.__changed:
+                return
+            if not os.path.isdir(self.__localDir):
+                os.makedirs(self.__localDir)
+            tmpFile = self.__path + '.tmp'
+            with open(tmpFile, 'w', encoding='utf8') as fh:
+                json.dump(self.__entries, fh, ensure_ascii=False)
+            os.replace(tmpFile, self.__path)
+            self.__changed = False
+
+
+class ListingCache:
+    """课件目录页面的缓存，用于反复抓取同一批目录（如监视模式）
+
+    以目录地址为键保存页面的 ETag/Last-Modified、内容摘要和解析结果，以文件地址为键保存文件信息。
+    再次抓取时目录页面使用条件请求，服务器返回 304 或者页面内容与上次相同时目录视为没有变化，
+    不再重新解析，其中的文件也直接使用上次的信息，不再查询元数据或发送 HEAD 请求。
+    目录页面中只有文件名，同名的文件被替换时目录不会变化，所以文件信息最多只使用 fileTtl 秒
+    """
+
+    def __init__(self, fileTtl=3600):
+        self.__fileTtl = fileTtl
+        self.__lock = threading.Lock()
+        # 目录地址 -> {'etag', 'lastModified', 'digest', 'listing'}
+        self.__listings = {}
+        # 文件地址 -> (FileInfo, 获取的时间)
+        self.__files = {}
+        self.__stats = {'notModified': 0, 'sameContent': 0, 'changed': 0}
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+    def conditionalHeaders(self, url):
+        """目录页面的条件请求头，没有缓存时为空"""
+        with self.__lock:
+            return SyncManifest.conditionalHeaders(self.__listings.get(url))
+
+    def update(self, url, response):
+        """用目录页面的响应更新缓存
+
+        return:
+            (文件链接列表, 子目录链接列表, 目录是否没有变化)
+        """
+        with self.__lock:
+            entry = self.__listings.get(url)
+        if entry and response.status_code == 304:
+            kind = 'notModified'
+        else:
+            digest = hashlib.sha1(response.content).hexdigest()
+            if entry and entry['digest'] == digest:
+                kind = 'sameContent'
+            else:
+                kind = 'changed'
+                entry = {'digest': digest, 'listing': parseListing(response.text)}
+            entry = dict(entry, etag=response.headers.get('ETag'),
+                         lastModified=response.headers.get('Last-Modified'))
+        with self.__lock:
+            self.__listings[url] = entry
+            self.__stats[kind] += 1
+        return entry['listing'] + (kind != 'changed',)
+
+    def getFile(self, url):
+        """上次得到的文件信息，超过 fileTtl 秒或者没有时返回 None"""
+        with self.__lock:
+            item = self.__files.get(url)
+        if item and time.time() - item[1] < self.__fileTtl:
+            return item[0]
+        return None
+
+    def setFile(self, fileInfo):
+        with self.__lock:
+            self.__files[fileInfo.url] = (fileInfo, time.time())
+
+
+class ContentStore:
+    """按内容寻址的课件仓库，用硬链接在多个课程之间共享相同的文件
+
+    仓库在同步目录下的 .ucas_store 中，每个文件以 "SHA1-大小" 命名，和课程目录中的文件是同一个文件的硬链接。
+    下载完成的文件加入仓库，已有相同内容时把新文件换成仓库中文件的硬链接，节省磁盘空间；
+    下载不小于 sampleThreshold 的文件前，如果仓库中有 ETag 和大小都相同、且开头 sampleSize 字节也一致的文件，
+    就直接链接而不再下载。只是首尾内容相同并不能说明是同一个文件，而链接后的文件会记入同步清单、不再检查，
+    所以没有相同 ETag 的文件仍然下载，下载后内容相同时再换成链接。
+    注意硬链接的文件内容是共享的，修改其中一个会影响所有课程中的同一个文件
+    """
+
+    dirName = '.ucas_store'
+
+    def __init__(self, localDir, sampleSize=65536, sampleThreshold=1024 * 1024):
+        self.__root = os.path.join(localDir, self.dirName)
+        self.__indexFile = os.path.join(self.__root, 'index.json')
+        self.__sampleSize = sampleSize
+        self.__sampleThreshold = sampleThreshold
+        self.__lock = threading.Lock()
+        self.__changed = False
+        # objects: {键: 大小}，etags: {ETag: 键}
+        self.__index = {'objects': {}, 'etags': {}}
+        self.__stats = {'linked': 0, 'bytesSaved': 0, 'deduplicated': 0, 'diskSaved': 0}
+        if os.path.isfile(self.__indexFile):
+            try:
+                with open(self.__indexFile, encoding='utf8') as fh:
+                    self.__index = json.load(fh)
+            except ValueError:
+                debug('仓库索引已损坏，重新建立: %s' % self.__indexFile)
+
+    @property
+    def stats(self):
+        """linked/bytesSaved: 直接链接而没有下载的文件数和字节数；deduplicated/diskSaved: 下载后换成链接的文件数和字节数"""
+        with self.__lock:
+            return dict(self.__stats)
+
+    def __objectPath(self, key):
+        return os.path.join(self.__root, key[:2], key)
+
+    def __candidates(self, size):
+        """仓库中大小为 size 的文件的键"""
+        with self.__lock:
+            keys = [k for k, s in self.__index['objects'].items() if s == size]
+        return [k for k in keys if os.path.isfile(self.__objectPath(k))]
+
+    @staticmethod
+    def hashFile(path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    @staticmethod
+    def linkFile(source, target):
+        """把 target 换成 source 的硬链接，不支持硬链接时复制"""
+        directory = os.path.dirname(target)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmpFile = target + '.link'
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        try:
+            os.link(source, tmpFile)
+            linked = True
+        except OSError:
+            shutil.copyfile(source, tmpFile)
+            linked = False
+        os.replace(tmpFile, target)
+        return linked
+
+    def __fetchSample(self, session, url, size):
+        """用 Range 请求获取文件开头的 sampleSize 字节，返回 (内容, 响应头)
+
+        服务器没有按 Range 返回时不读取响应体（可能是整个大文件），内容为 None
+        """
+        r = session.get(url, stream=True, headers={'Range': 'bytes=0-%d' % (self.__sampleSize - 1)})
+        with contextlib.closing(r):
+            if r.status_code != 206 or parseContentRange(r.headers.get('Content-Range')) != (0, size):
+                return None, r.headers
+            return r.content, r.headers
+
+    @staticmethod
+    def __readSample(path, start, length):
+        with open(path, 'rb') as fh:
+            fh.seek(start)
+            return fh.read(length)
+
+    def linkDuplicate(self, session, downloadTask, manifest=None):
+        """仓库中已有和服务器上相同的文件时直接链接到 downloadTask.localFile
+
+        return:
+            是否已经链接，为 False 时需要下载
+        """
+        size = downloadTask.size
+        if not size or size < self.__sampleThreshold:
+            return False
+        candidates = self.__candidates(size)
+        if not candidates:
+            return False
+
+        head, headers = self.__fetchSample(session, downloadTask.url, size)
+        if head is None:
+            return False
+        etag, lastModified = headers.get('ETag'), headers.get('Last-Modified')
+        with self.__lock:
+            key = etag and self.__index['etags'].get(etag)
+        # ETag 相同时再比较开头的内容，以防不同文件的 ETag 碰巧相同
+        if key not in candidates or self.__readSample(self.__objectPath(key), 0, len(head)) != head:
+            return False
+
+        self.linkFile(self.__objectPath(key), downloadTask.localFile)
+        partFile = downloadTask.localFile + '.part'
+        if os.path.isfile(partFile):
+            os.remove(partFile)
+        removePartInfo(partFile)
+        if manifest:
+            manifest.update(downloadTask.url, downloadTask.localFile, size, etag, lastModified)
+        with self.__lock:
+            self.__stats['linked'] += 1
+            self.__stats['bytesSaved'] += size
+            self.__changed = True
+        debug('链接仓库中的相同文件: %s' % downloadTask.localFile)
+        return True
+
+    def add(self, localFile, etag=None):
+        """把下载完成的文件加入仓库，已有相同内容的文件时换成它的硬链接
+
+        return:
+            localFile 是否被换成了仓库中的文件。换成的文件修改时间不同，调用者需要更新同步清单中的记录
+        """
+        size = os.path.getsize(localFile)
+        key = '%s-%d' % (self.hashFile(localFile), size)
+        objectPath = self.__objectPath(key)
+        replaced = False
+        with self.__lock:
+            if os.path.isfile(objectPath):
+                if not os.path.samefile(objectPath, localFile):
+                    linked = self.linkFile(objectPath, localFile)
+                    replaced = True
+                    if linked:
+                        self.__stats['deduplicated'] += 1
+                        self.__stats['diskSaved'] += size
+            else:
+                if not os.path.isdir(os.path.dirname(objectPath)):
+                    os.makedirs(os.path.dirname(objectPath))
+                try:
+                    os.link(localFile, objectPath)
+                except OSError:
+                    # 文件系统不支持硬链接时仓库只会多占一份空间，不再加入
+                    return False
+            self.__index['objects'][key] = size
+            if etag:
+                self.__index['etags'][etag] = key
+            self.__changed = True
+        return replaced
+
+    def prune(self):
+        """删除只剩仓库中一个链接的文件（对应的课件已经被删除），返回释放的字节数"""
+        freed = 0
+        with self.__lock:
+            for key, size in list(self.__index['objects'].items()):
+                objectPath = self.__objectPath(key)
+                if os.path.isfile(objectPath) and os.stat(objectPath).st_nlink > 1:
+                    continue
+                if os.path.isfile(objectPath):
+                    os.remove(objectPath)
+                    freed += size
+                del self.__index['objects'][key]
+                self.__changed = True
+            self.__index['etags'] = {e: k for e, k in self.__index['etags'].items() if k in self.__index['objects']}
+        return freed
+
+    def save(self):
+        with self.__lock:
+            if not self.__changed:
+                return
+            if not os.path.isdir(self.__root):
+                os.makedirs(self.__root)
+            tmpFile = self.__indexFile + '.tmp'
+            with open(tmpFile, 'w', encoding='utf8') as fh:
+                json.dump(self.__index, fh)
+            os.replace(tmpFile, self.__indexFile)
+            self.__changed = False
+
+
+class PoolStats:
+    """连接池统计，用于根据实际负载调整连接池大小"""
 
     def __init__(self):
-        self.__session = requests.Session()
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__newConnections = 0
+        self.__waits = 0
+        self.__waitTime = 0
+        self.__active = 0
+        self.__peakActive = 0
+
+    def addRequest(self):
+        with self.__lock:
+            self.__requests += 1
+
+    def addNewConnection(self):
+        with self.__lock:
+            self.__newConnections += 1
+
+    def addWait(self, seconds):
+        with self.__lock:
+            self.__waits += 1
+            self.__waitTime += seconds
+
+    def checkOut(self):
+        with self.__lock:
+            self.__active += 1
+            self.__peakActive = max(self.__peakActive, self.__active)
+
+    def checkIn(self):
+        with self.__lock:
+            self.__active -= 1
+
+    @property
+    def active(self):
+        """正在使用（包括正在读取响应体）的连接数"""
+        return self.__active
+
+    def snapshot(self):
+        """返回当前的统计信息
+
+        reuseRate: 复用已有连接的请求所占比例
+        waits/waitTime: 因连接池中没有空闲连接而等待的次数和总时间（秒）
+        active/peakActive: 当前和最多同时使用的连接数
+        """
+        with self.__lock:
+            return {
+                'requests': self.__requests,
+                'newConnections': self.__newConnections,
+                'reuseRate': 1 - self.__newConnections / self.__requests if self.__requests else 0,
+                'waits': self.__waits,
+                'waitTime': self.__waitTime,
+                'active': self.__active,
+                'peakActive': self.__peakActive,
+            }
+
+
+class StatsPoolMixin:
+    """在 urllib3 连接池中记录请求数、新建连接数和等待空闲连接的时间"""
+
+    stats = None
+
+    def urlopen(self, *args, **kwargs):
+        self.stats.addRequest()
+        return super().urlopen(*args, **kwargs)
+
+    def _new_conn(self):
+        self.stats.addNewConnection()
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        startTime = time.time()
+        conn = super()._get_conn(timeout)
+        waitTime = time.time() - startTime
+        if waitTime > 0.001:
+            self.stats.addWait(waitTime)
+        self.stats.checkOut()
+        return conn
+
+    def _put_conn(self, conn):
+        # 出错时 urllib3 也会调用 _put_conn(None) 归还名额
+        self.stats.checkIn()
+        return super()._put_conn(conn)
+
+
+class TunedHTTPAdapter(HTTPAdapter):
+    """可统计连接池使用情况的 HTTPAdapter"""
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.__usePoolClasses(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        # 使用代理时连接池由代理的 PoolManager 创建，同样需要统计
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        self.__usePoolClasses(manager)
+        return manager
+
+    def __usePoolClasses(self, manager):
+        attrs = {'stats': self.stats}
+        manager.pool_classes_by_scheme = {
+            'http': type('StatsHTTPConnectionPool', (StatsPoolMixin, HTTPConnectionPool), attrs),
+            'https': type('StatsHTTPSConnectionPool', (StatsPoolMixin, HTTPSConnectionPool), attrs),
+        }
+
+
+class DiskCache:
+    """保存在磁盘上的缓存
+
+    每一项都有自己的写入时间，超过 ttl 秒后视为过期。
+    已有且未过期的项被重新写入时只更新值，不延长有效期，这样缓存的内容至少每 ttl 秒会重新获取一次
+    """
+
+    def __init__(self, path, ttl=86400):
+        self.__path = path
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, encoding='utf8') as fh:
+                    self.__entries = json.load(fh)
+            except ValueError:
+                debug('缓存文件已损坏，重新建立: %s' % path)
+
+    @staticmethod
+    def forUser(username, ttl=86400, directory=None):
+        """每个用户使用单独的缓存文件"""
+        return DiskCache(userCacheFile(username, '.json', directory), ttl)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __isFresh(self, entry):
+        return entry and time.time() - entry['time'] < self.__ttl
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return entry['value'] if self.__isFresh(entry) else default
+
+    def set(self, key, value):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            self.__entries[key] = {'time': entry['time'] if self.__isFresh(entry) else time.time(), 'value': value}
+
+    def invalidate(self, *keys):
+        """使指定的项失效，没有指定时清空整个缓存"""
+        with self.__lock:
+            if not keys:
+                self.__entries.clear()
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def save(self):
+        with self.__lock:
+            directory = os.path.dirname(self.__path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmpFile = self.__path + '.tmp'
+            with open(tmpFile, 'w', encoding='utf8') as fh:
+                json.dump(self.__entries, fh, ensure_ascii=False)
+            os.replace(tmpFile, self.__path)
+
+
+class CookieStore:
+    """把会话的 Cookie 保存在磁盘上，下次运行时不用重新登录
+
+    文件中保存的是登录凭据，只有当前用户可以读写
+    """
+
+    Fields = ('name', 'value', 'domain', 'path', 'expires', 'secure')
+
+    def __init__(self, path):
+        self.__path = path
+
+    @staticmethod
+    def forUser(username, directory=None):
+        return CookieStore(userCacheFile(username, '.cookies', directory))
+
+    @property
+    def path(self):
+        return self.__path
+
+    def load(self, jar):
+        """把保存的 Cookie 加入 jar，返回加入的个数"""
+        if not os.path.isfile(self.__path):
+            return 0
+        try:
+            with open(self.__path, encoding='utf8') as fh:
+                cookies = json.load(fh)
+        except ValueError:
+            return 0
+        count = 0
+        for c in cookies:
+            cookie = requests.cookies.create_cookie(**c)
+            if not cookie.is_expired():
+                jar.set_cookie(cookie)
+                count += 1
+        return count
+
+    def save(self, jar):
+        directory = os.path.dirname(self.__path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        cookies = [{k: getattr(c, k) for k in self.Fields} for c in jar]
+        tmpFile = self.__path + '.tmp'
+        fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w', encoding='utf8') as fh:
+            json.dump(cookies, fh)
+        os.replace(tmpFile, self.__path)
+
+    def clear(self):
+        if os.path.isfile(self.__path):
+            os.remove(self.__path)
+
+
+def userCacheFile(username, suffix, directory=None):
+    """用户的缓存文件，文件名中不直接出现用户名"""
+    directory = directory or os.path.join(os.path.expanduser('~'), '.cache', 'UCASCourse')
+    name = hashlib.sha1(username.encode('utf8')).hexdigest()[:16]
+    return os.path.join(directory, name + suffix)
+
+
+class TokenBucket:
+    """令牌桶，限制整个进程发出请求的速率"""
+
+    def __init__(self, rate, burst=None):
+        """
+        args:
+            rate: 每秒发放的令牌数（请求数）
+            burst: 桶的容量，即空闲后最多可以连续发出的请求数
+        """
+        self.__rate = rate
+        self.__burst = burst or max(1, rate)
+        self.__tokens = self.__burst
+        self.__lastTime = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """取得一个令牌，没有令牌时等待"""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__lastTime) * self.__rate)
+            self.__lastTime = now
+            # 先预订令牌再在锁外等待，等待中的线程按到达顺序依次得到令牌
+            self.__tokens -= 1
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """按 AIMD（加性增、乘性减）调整同时进行的请求数
+
+    最近请求的平均延迟接近基准延迟时每完成一轮请求并发数加 1；平均延迟超过基准的 tolerance 倍、
+    服务器返回 5xx/429 或者连接失败、超时时并发数减半，每个延迟周期内最多减半一次。
+    基准延迟取最小延迟，并非常缓慢地向当前延迟靠拢，以适应服务器状态的长期变化。
+    用平均延迟而不是单个请求的延迟判断拥塞，个别较慢的页面不会导致并发数下降
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, tolerance=2.0):
+        self.__minimum = minimum
+        self.__maximum = max(minimum, maximum)
+        self.__tolerance = tolerance
+        self.__limit = float(min(max(initial, minimum), self.__maximum))
+        self.__inFlight = 0
+        self.__baseline = None
+        self.__average = None
+        self.__lastDecrease = 0
+        self.__condition = threading.Condition()
+        self.__stats = {'increase': 0, 'decrease': 0, 'failed': 0, 'peakLimit': int(self.__limit)}
+
+    @property
+    def limit(self):
+        return int(self.__limit)
+
+    @property
+    def maximum(self):
+        return self.__maximum
+
+    @property
+    def stats(self):
+        with self.__condition:
+            return dict(self.__stats, limit=self.limit, baseline=self.__baseline, average=self.__average)
+
+    def acquire(self):
+        """占用一个并发名额，名额用完时等待"""
+        with self.__condition:
+            while self.__inFlight >= int(self.__limit):
+                self.__condition.wait()
+            self.__inFlight += 1
+
+    def release(self, latency=None, failed=False):
+        """释放名额并根据这次请求的结果调整并发数
+
+        args:
+            latency: 请求的延迟（秒），为 None 时只释放名额（如请求本身有错误）
+            failed: 是否说明服务器过载（5xx、429、连接失败或超时）
+        """
+        with self.__condition:
+            self.__inFlight -= 1
+            self.__condition.notify_all()
+            if latency is None:
+                return
+            if failed:
+                self.__stats['failed'] += 1
+            else:
+                if self.__baseline is None or latency < self.__baseline:
+                    self.__baseline = latency
+                else:
+                    self.__baseline += (latency - self.__baseline) * 0.001
+                self.__average = latency if self.__average is None else self.__average * 0.9 + latency * 0.1
+            # 延迟很小时（如局域网）加上固定的 20ms，避免抖动被当作拥塞
+            congested = failed or self.__average > self.__baseline * self.__tolerance + 0.02
+            now = time.monotonic()
+            if congested:
+                if now - self.__lastDecrease > max(latency, self.__average or 0):
+                    self.__limit = max(self.__minimum, self.__limit / 2)
+                    self.__lastDecrease = now
+                    self.__stats['decrease'] += 1
+            elif self.__limit < self.__maximum:
+                self.__limit = min(self.__maximum, self.__limit + 1 / self.__limit)
+                self.__stats['increase'] += 1
+                self.__stats['peakLimit'] = max(self.__stats['peakLimit'], int(self.__limit))
+
+
+class HedgedRequests:
+    """对冲请求：一个请求迟迟没有返回时再发一个相同的请求，使用先返回的结果
+
+    等待的时间是最近请求耗时的 percentile 分位数，但不少于 minDelay 秒，所以只有少数最慢的请求会被对冲。
+    同时进行的对冲请求最多 maxHedges 个，服务器整体变慢时请求数不会翻倍。
+    只用于目录页面这样幂等且不大的 GET 请求
+    """
+
+    def __init__(self, minDelay=1.0, percentile=0.95, maxHedges=2, window=200):
+        self.__minDelay = minDelay
+        self.__percentile = percentile
+        self.__slots = threading.Semaphore(maxHedges)
+        self.__latencies = collections.deque(maxlen=window)
+        self.__lock = threading.Lock()
+        self.__stats = {'requests': 0, 'hedged': 0, 'hedgeWon': 0}
+
+    @property
+    def delay(self):
+        """发出对冲请求前等待的秒数"""
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+        if not latencies:
+            return self.__minDelay
+        return max(self.__minDelay, latencies[min(len(latencies) - 1, int(len(latencies) * self.__percentile))])
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+    def get(self, session, url, **kwargs):
+        results = queue.Queue()
+
+        def fetch(hedge):
+            startTime = time.monotonic()
+            try:
+                results.put((hedge, session.get(url, **kwargs), None))
+                with self.__lock:
+                    self.__latencies.append(time.monotonic() - startTime)
+            except Exception as e:
+                results.put((hedge, None, e))
+            finally:
+                if hedge:
+                    self.__slots.release()
+
+        with self.__lock:
+            self.__stats['requests'] += 1
+        threading.Thread(target=fetch, args=(False,), daemon=True).start()
+        started = 1
+        try:
+            hedge, r, error = results.get(timeout=self.delay)
+        except queue.Empty:
+            if self.__slots.acquire(blocking=False):
+                with self.__lock:
+                    self.__stats['hedged'] += 1
+                threading.Thread(target=fetch, args=(True,), daemon=True).start()
+                started = 2
+            hedge, r, error = results.get()
+            # 先返回的请求出错时等另一个请求的结果
+            if error and started == 2:
+                hedge, r, error = results.get()
+        if error:
+            raise error
+        if hedge:
+            with self.__lock:
+                self.__stats['hedgeWon'] += 1
+        return r
+
+
+class UCASSession(requests.Session):
+    """UCAS 使用的会话
+
+    抓取线程和下载线程共用同一个会话。每个主机最多保持 poolSize 个长连接，
+    连接都在使用中时请求会等待空闲连接而不是另外新建连接再丢弃；
+    幂等的 GET/HEAD 请求在连接失败或服务器返回 5xx 时按指数退避自动重试。
+
+    课程网站的请求被重定向到登录页面时（如使用缓存中的地址而还没有进入课程网站），
+    调用 onLoginRedirect 重新进入课程网站后再请求一次。
+
+    所有请求都先经过令牌桶 rateLimiter 和并发控制 concurrency。stream=True 的请求在收到响应头后
+    就释放并发名额，响应体的读取由下载的连接名额 ConnectionBudget 控制。
+
+    没有指定 timeout 的请求都使用会话的 (连接超时, 读取超时)，一个没有响应的连接不会让线程永远等下去；
+    下载时读取超时就是停顿检测的时间，超过这么久没有收到数据会重新连接并续传
+    """
+
+    def __init__(self, poolSize=10, retries=3, backoffFactor=0.5, concurrency=None, rateLimiter=None,
+                 timeout=(10, 30), hedger=None):
+        """
+        args:
+            concurrency: AdaptiveConcurrency，为 None 时不限制同时进行的请求数
+            rateLimiter: TokenBucket，为 None 时不限制请求速率
+            timeout: 默认的 (连接超时, 读取超时)（秒）
+            hedger: HedgedRequests，getHedged 使用的对冲请求，为 None 时不对冲
+        """
+        super().__init__()
+        self.concurrency = concurrency
+        self.rateLimiter = rateLimiter
+        self.timeout = timeout
+        self.hedger = hedger
+        self.__stats = PoolStats()
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoffFactor,
+                      status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET', 'HEAD']),
+                      raise_on_status=False)
+        for prefix in ('http://', 'https://'):
+            self.mount(prefix, TunedHTTPAdapter(self.__stats, pool_connections=4, pool_maxsize=poolSize,
+                                                max_retries=retry, pool_block=True))
+        self.headers['Connection'] = 'keep-alive'
+        self.onLoginRedirect = None
+        self.__reloginLock = threading.Lock()
+        self.__reloginCount = 0
+        self.__local = threading.local()
+
+    @property
+    def stats(self):
+        return self.__stats
+
+    @staticmethod
+    def isLoginRedirect(url, response):
+        """请求课程网站的 url 是否被重定向到了登录页面"""
+        if urllib.parse.urlsplit(url).netloc != 'course.ucas.ac.cn' or not response.history:
+            return False
+        final = urllib.parse.urlsplit(response.url)
+        return final.netloc == 'sep.ucas.ac.cn' or 'login' in final.path
+
+    def __limitedRequest(self, method, url, *args, **kwargs):
+        if self.rateLimiter:
+            self.rateLimiter.acquire()
+        if not self.concurrency:
+            return super().request(method, url, *args, **kwargs)
+        self.concurrency.acquire()
+        startTime = time.monotonic()
+        try:
+            r = super().request(method, url, *args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.concurrency.release(time.monotonic() - startTime, True)
+            raise
+        except Exception:
+            self.concurrency.release()
+            raise
+        # 被 Retry 重试成功的 5xx 和连接错误也说明服务器已经过载
+        retries = getattr(r.raw, 'retries', None)
+        failed = r.status_code >= 500 or r.status_code == 429 or bool(retries and retries.history)
+        self.concurrency.release(time.monotonic() - startTime, failed)
+        return r
+
+    def getHedged(self, url, **kwargs):
+        """GET 请求，较慢时发送对冲请求"""
+        if not self.hedger:
+            return self.get(url, **kwargs)
+        return self.hedger.get(self, url, **kwargs)
+
+    def request(self, method, url, *args, **kwargs):
+        if not args:
+            kwargs.setdefault('timeout', self.timeout)
+        r = self.__limitedRequest(method, url, *args, **kwargs)
+        if self.onLoginRedirect and not getattr(self.__local, 'relogging', False) and \
+                self.isLoginRedirect(url, r):
+            count = self.__reloginCount
+            with self.__reloginLock:
+                # 其它线程已经重新进入过课程网站时直接重试
+                if count == self.__reloginCount:
+                    self.__local.relogging = True
+                    try:
+                        self.onLoginRedirect()
+                    finally:
+                        self.__local.relogging = False
+                    self.__reloginCount += 1
+            r = self.__limitedRequest(method, url, *args, **kwargs)
+        return r
+
+
+class UCAS:
+
+    CourseIdentityUrl = 'http://sep.ucas.ac.cn/portal/site/16/801'
+
+    def __init__(self, poolSize=10, retries=3, backoffFactor=0.5, cache=None, cookieStore=None,
+                 concurrency=None, rate=0, timeout=(10, 30), hedgeDelay=0):
+        """
+        args:
+            poolSize: 每个主机的连接池大小，应不小于抓取和下载的并发数
+            retries: GET/HEAD 请求失败后的重试次数
+            backoffFactor: 重试的指数退避系数（秒）
+            cache: DiskCache，缓存工具链接、课程列表和用户信息，为 None 时不缓存
+            cookieStore: CookieStore，保存登录后的 Cookie，为 None 时每次都要登录
+            concurrency: AdaptiveConcurrency，所有请求共用的并发控制，为 None 时不限制
+            rate: 每秒最多发出的请求数，为 0 时不限制
+            timeout: 请求的 (连接超时, 读取超时)（秒）
+            hedgeDelay: 目录页面至少等待多少秒后发送对冲请求，为 0 时不对冲
+        """
+        self.__session = UCASSession(poolSize, retries, backoffFactor, concurrency,
+                                     TokenBucket(rate) if rate > 0 else None, timeout,
+                                     HedgedRequests(hedgeDelay) if hedgeDelay > 0 else None)
+        self.__session.onLoginRedirect = self.__enterCourseSite
+        self.__metadata = MetadataSource(self.__session)
+        self.__cache = cache
+        self.__cookieStore = cookieStore
+        # 按站点 ID 保存已解析的工具链接
+        self.__toolUrlCache = (cache and cache.get('toolUrls')) or {}
+        # 按作业详情链接保存已获取的作业
+        self.__homeworkCache = (cache and cache.get('homework')) or {}
+        # 按站点 ID 保存已获取的学生名单，磁盘上按学期分开缓存，在得到课程列表后读取
+        self.__rosterCache = {}
         # 课程网站 工具链接
         self.__courseSiteToolListUrls = None
         self.__courses = None
-        self.__userInfo = None
+        self.__userInfo = (cache and cache.get('userInfo')) or None
 
     def getCaptcha(self):
         """获取验证码"""
@@ -254,12 +1841,31 @@ class UCAS:
             fh.write(r.content)
         return file
 
-    def login(self, username, password):
-        """登录UCAS"""
+    def isLoggedIn(self):
+        """用一个轻量的请求检查当前会话是否仍然有效"""
+        r = self.session.get(self.CourseIdentityUrl)
+        return r.ok and findFirst(parseHtml(r.text), '//a[contains(@href, "Identity=")]') is not None
+
+    def login(self, username, password, interactive=True):
+        """登录UCAS
+
+        保存的会话仍然有效时直接使用，不需要输入验证码
+
+        args:
+            interactive: 为 False 时如果需要输入验证码则直接返回失败
+        """
 
         hostUrl = 'http://sep.ucas.ac.cn'
         loginUrl = 'http://sep.ucas.ac.cn/slogin'
 
+        if self.__cookieStore and self.__cookieStore.load(self.session.cookies):
+            if self.isLoggedIn():
+                debug('使用保存的会话')
+                return True, None
+            self.session.cookies.clear()
+        if not interactive:
+            return False, '保存的会话已失效，需要输入验证码重新登录'
+
         self.session.get(hostUrl)
 
         print("Loading captcha...")
@@ -274,13 +1880,64 @@ class UCAS:
                 'certCode': certCode,
                 'sb': 'sb'}
         result = self.session.post(loginUrl, data=data)
-        rr = BeautifulSoup(result.text, BeautifulSoupDefaultParser).find('div', class_='alert alert-error')
-        return (False, rr.text) if rr else (True, None)
+        rr = findFirst(parseHtml(result.text), '//div[%s]' % xpathHasClass('alert-error'))
+        if rr is not None:
+            return False, rr.text_content()
+        self.saveSession()
+        return True, None
+
+    def saveSession(self):
+        """保存会话的 Cookie，包括进入课程网站后得到的 Cookie"""
+        if self.__cookieStore:
+            self.__cookieStore.save(self.session.cookies)
 
     @property
     def session(self):
         return self.__session
 
+    @property
+    def metadata(self):
+        """所有课程共用的课件元数据来源"""
+        return self.__metadata
+
+    @property
+    def poolStats(self):
+        """连接池统计信息"""
+        return self.session.stats.snapshot()
+
+    @property
+    def cache(self):
+        return self.__cache
+
+    def saveCache(self):
+        """把已经获取到的工具链接、课程列表和用户信息写入缓存"""
+        if not self.cache:
+            return
+        self.cache.set('toolUrls', self.__toolUrlCache)
+        self.cache.set('homework', self.__homeworkCache)
+        if self.__courses:
+            self.cache.set('courses', [(c.name, c.url) for c in self.__courses])
+            rosters = {}
+            for c in self.__courses:
+                if c.siteId in self.__rosterCache:
+                    rosters.setdefault(self.rosterCacheKey(c.term), {})[c.siteId] = self.__rosterCache[c.siteId]
+            for key, value in rosters.items():
+                self.cache.set(key, value)
+        if self.__userInfo:
+            self.cache.set('userInfo', self.__userInfo)
+        self.cache.save()
+
+    def invalidateCache(self):
+        """清空缓存，之后的数据都重新获取"""
+        self.__toolUrlCache.clear()
+        self.__homeworkCache.clear()
+        self.__rosterCache.clear()
+        self.__courseSiteToolListUrls = None
+        self.__courses = None
+        self.__userInfo = None
+        if self.cache:
+            self.cache.invalidate()
+
     @property
     def userInfo(self):
         if not self.__userInfo:
@@ -289,62 +1946,88 @@ class UCAS:
             html = self.session.get(url).text
             pattern = re.compile(r'当前登录用户：([^(]+)\((\d+)\)')
             matched = pattern.search(html)
-            self.__userInfo = (matched.group(1), matched.group(2))
+            self.__userInfo = [matched.group(1), matched.group(2)]
         return self.__userInfo
 
     @property
     def courseSiteToolListUrls(self):
-        if not self.__courseSiteToolListUrls:
+        if self.__courseSiteToolListUrls is None:
             self.__courseSiteToolListUrls = self.__getCourseSiteToolListUrls()
         return self.__courseSiteToolListUrls
 
     @property
     def courses(self):
         if not self.__courses:
-            self.__courses = [Course(self.session, c.name, c.url) for c in self.__getCourseListUrls()]
+            links = [LinkInfo(*x) for x in self.cache.get('courses', [])] if self.cache else []
+            self.__courses = [Course(self.session, c.name, c.url, self.metadata, self.__toolUrlCache,
+                                     self.__homeworkCache, self.__rosterCache)
+                              for c in links or self.__getCourseListUrls()]
+            if self.cache:
+                for key in {self.rosterCacheKey(c.term) for c in self.__courses}:
+                    self.__rosterCache.update(self.cache.get(key) or {})
         return self.__courses
 
+    @staticmethod
+    def rosterCacheKey(term):
+        """学生名单按学期缓存，没有学期信息的课程放在一起"""
+        return 'roster:%d-%d' % term if term else 'roster:'
+
+    def getRosterIndex(self, courses=None, threadCount=4):
+        """建立课程学生名单的倒排索引 RosterIndex，courses 为 None 时使用所有课程"""
+        return RosterIndex.fromCourses(self.courses if courses is None else courses, threadCount)
+
     @staticmethod
     def getIFrameRealSrc(session, url):
         """获取 iframe 标签的真实地址"""
         try:
             html = session.get(url).text
-            url = BeautifulSoup(html, BeautifulSoupDefaultParser).iframe['src']
+            url = findFirst(parseHtml(html), '//iframe').attrib['src']
         except:
             pass
         return url
 
     @staticmethod
-    def getToolListUrls(session, html):
-        """获取网站左边的那个工具栏中的工具"""
+    def getToolListUrls(session, html, siteId=None, cache=None):
+        """获取网站左边的那个工具栏中的工具
+
+        返回的 ToolUrls 在用到某个工具时才解析它的真实地址
 
-        aList = BeautifulSoup(html, BeautifulSoupDefaultParser)('a', class_=re.compile('icon-sakai-.+'))
-        rToolList = {entry.text.strip(): UCAS.getIFrameRealSrc(session, entry['href']) for entry in aList}
-        return rToolList
+        args:
+            html: 页面内容，或者已经用 parseHtml 解析好的页面
+            siteId, cache: 见 ToolUrls
+        """
+        return ToolUrls(session, siteId, html=html, cache=cache)
 
     def __getCourseSiteToolListUrls(self):
-        """获取"课程网站"的工具链接"""
+        """获取"课程网站"的工具链接
+
+        缓存中已有的工具直接使用，只有用到缓存中没有的工具时才进入课程网站获取工具页
+        """
+        return ToolUrls(self.session, '~workspace', cache=self.__toolUrlCache, loader=self.__enterCourseSite)
+
+    def __enterCourseSite(self):
+        """从 SEP 进入"课程网站"，返回工具页"""
 
         baseUrl = "http://course.ucas.ac.cn"
-        courseIdentityUrl = 'http://sep.ucas.ac.cn/portal/site/16/801'
 
-        html = self.session.get(courseIdentityUrl).text
-        r = BeautifulSoup(html, BeautifulSoupDefaultParser).find('a', href=re.compile('Identity='))['href']
+        html = self.session.get(self.CourseIdentityUrl).text
+        r = findFirst(parseHtml(html), '//a[contains(@href, "Identity=")]').attrib['href']
         html = self.session.get(r).text
-        r = BeautifulSoup(html, BeautifulSoupDefaultParser).find('frame', title='mainFrame')['src']
+        r = findFirst(parseHtml(html), '//frame[@title="mainFrame"]').attrib['src']
         url = baseUrl + r
-        html = self.session.get(url).text
-        toolList = UCAS.getToolListUrls(self.session, html)
-        toolList['我的信息'] = baseUrl + UCAS.getIFrameRealSrc(self.session, BeautifulSoup(html, BeautifulSoupDefaultParser).find('iframe', title='我的空间信息 ')['src'])
-        return toolList
+        # 工具页只解析一次，工具栏和"我的空间信息"都从同一棵树中提取
+        doc = parseHtml(self.session.get(url).text)
+        workspace = self.__toolUrlCache.setdefault('~workspace', {'tools': {}, 'complete': False})
+        workspace['tools']['我的信息'] = baseUrl + UCAS.getIFrameRealSrc(
+            self.session, findFirst(doc, '//iframe[@title="我的空间信息 "]').attrib['src'])
+        return doc
 
     def __getCourseListUrls(self):
         """获取所有课程链接"""
         # myCourseUrl = self.courseSiteToolListUrls[0]
         myCourseUrl = self.courseSiteToolListUrls['我的课程']
         html = self.session.get(myCourseUrl).text
-        return [LinkInfo(name=e.text.strip(), url=e['href']) for e in
-                BeautifulSoup(html, BeautifulSoupDefaultParser).table('a', href=re.compile(r'http://course.ucas.ac.cn/portal/site/\d+'))]
+        return parseCourseLinks(html)
 
     def getMatchedCourses(self, *namePatterns):
         """获取匹配条件的课程"""
@@ -361,9 +2044,286 @@ class UCAS:
         namePattern = r'%s[-\d{2}]?%s' % (curYear, curSeason)
         return self.getMatchedCourses(namePattern)
 
+    def getBatchCourses(self, namePatterns=None, priority='recent'):
+        """一次选出多个学期、多门课程，并按优先级排序
 
-def download(session, downloadTask, reportProgress=None):
-    """下载文件"""
+        排在前面的课程先抓取目录、先下载，所以当前学期的课件最先同步完成
+
+        args:
+            namePatterns: 课程名的正则表达式列表，为空时选择所有课程
+            priority: recent 按学期从新到旧排序，没有学期信息的课程排在最后；
+                order 按 namePatterns 的顺序排序，先匹配到的课程在前
+        """
+        patterns = list(map(re.compile, namePatterns or []))
+        courses = self.courses
+        if patterns:
+            ranks = {}
+            for course in courses:
+                rank = next((i for i, p in enumerate(patterns) if p.search(course.name)), None)
+                if rank is not None:
+                    ranks[course.url] = rank
+            courses = [c for c in courses if c.url in ranks]
+        if priority == 'recent':
+            # sorted 是稳定的，同一学期的课程保持课程列表中的顺序
+            return sorted(courses, key=lambda c: c.term or (-1, 0), reverse=True)
+        if priority == 'order':
+            return sorted(courses, key=lambda c: ranks[c.url]) if patterns else list(courses)
+        raise ValueError('未知的优先级: %s' % priority)
+
+
+# 页面解析
+# 直接使用 lxml 解析，每个页面只解析一次，只用 XPath 取出需要的元素
+
+
+def parseHtml(html):
+    """解析页面，已经解析好的页面原样返回"""
+    if not isinstance(html, (str, bytes)):
+        return html
+    if not html.strip():
+        html = '<html></html>'
+    try:
+        return lxml.html.fromstring(html)
+    except ValueError:
+        # 带编码声明的 XML 页面不能以 str 解析
+        return lxml.html.fromstring(html.encode('utf8'))
+
+
+def findFirst(doc, xpath):
+    """返回第一个匹配 xpath 的元素，没有时返回 None"""
+    result = doc.xpath(xpath)
+    return result[0] if result else None
+
+
+def xpathHasClass(className):
+    """匹配 class 属性中含有 className 的 XPath 条件"""
+    return 'contains(concat(" ", normalize-space(@class), " "), " %s ")' % className
+
+
+def textOf(e):
+    return e.text_content().strip()
+
+
+def parseListing(html):
+    """解析课件目录页面，返回 (文件链接列表, 子目录链接列表)"""
+    links = [LinkInfo(name=textOf(e), url=e.get('href')) for e in parseHtml(html).xpath('(//table)[1]//a[@href]')]
+    files = [x for x in links if not x.url.endswith('/')]
+    # 删除 ..
+    folders = [x for x in links if x.url.endswith('/') and not x.url.startswith('..')]
+    return files, folders
+
+
+def parseToolLinks(html):
+    """解析站点左边工具栏中的工具链接"""
+    return [LinkInfo(name=textOf(e), url=e.get('href'))
+            for e in parseHtml(html).xpath('//a[contains(@class, "icon-sakai-")]')]
+
+
+def parseCourseLinks(html):
+    """解析"我的课程"页面中的课程链接"""
+    pattern = re.compile(r'http://course.ucas.ac.cn/portal/site/\d+')
+    return [LinkInfo(name=textOf(e), url=e.get('href')) for e in parseHtml(html).xpath('(//table)[1]//a[@href]')
+            if pattern.search(e.get('href'))]
+
+
+def parseStudents(html):
+    """解析"应用统计"页面中的学生列表 [(学号, 姓名), ...]"""
+    rList = []
+    for row in parseHtml(html).xpath('(//table)[2]//tr'):
+        tds = row.xpath('.//td')
+        if len(tds):
+            rList.append((textOf(tds[1]), textOf(tds[2])))
+    return rList
+
+
+def parseHomeworkList(html):
+    """解析作业列表页面，返回 [(详情链接, 状态, 开始日期, 截止日期), ...]"""
+    rList = []
+    for row in parseHtml(html).xpath('(//table)[1]//tr'):
+        tds = row.xpath('.//td')
+        if len(tds):
+            rList.append((tds[1].xpath('.//a')[0].get('href'), textOf(tds[2]), textOf(tds[3]), textOf(tds[4])))
+    return rList
+
+
+def parseHomeworkDetail(html):
+    """解析作业详情页面，返回 (作业名, 作业内容, 附件链接列表)"""
+    doc = parseHtml(html)
+    name = textOf(doc.xpath('(//table)[1]//td')[0])
+    content = findFirst(doc, '//div[%s]' % xpathHasClass('textPanel'))
+    content = textOf(content) if content is not None else None
+    attachments = None
+    if '作业的附加资源' in doc.text_content():
+        attachList = findFirst(doc, '//*[%s]' % xpathHasClass('attachList'))
+        if attachList is not None:
+            attachments = [LinkInfo(name=textOf(e), url=e.get('href')) for e in attachList.xpath('.//a[@href]')]
+    return name, content, attachments
+
+
+# 下载过程中可以通过重新连接、续传恢复的错误，copyResponse 直接读取 http.client 的响应，
+# 所以还包括套接字超时、连接重置和 http.client 的错误
+ResumableErrors = (requests.ConnectionError, requests.Timeout, urllib3.exceptions.HTTPError,
+                   TimeoutError, ConnectionError, http.client.HTTPException)
+
+# copyResponse 每次读取的块大小范围，以及下载进度报告的最小间隔（秒）
+MinChunkSize = 64 * 1024
+MaxChunkSize = 1024 * 1024
+ProgressInterval = 0.2
+
+# 每个下载线程重复使用的读缓冲区
+copyBuffers = threading.local()
+
+
+def copyResponse(response, outfh, length=None, onData=None):
+    """把响应体写入 outfh，返回写入的字节数
+
+    直接用底层 http.client 响应的 readinto 读到每个线程重复使用的缓冲区中，不为每块数据创建新的 bytes 对象。
+    块的大小在 MinChunkSize 和 MaxChunkSize 之间调整：很快读满一块时加倍，读得慢时减半，慢速连接上仍能及时报告进度。
+    读完整个响应后把连接归还连接池
+
+    args:
+        length: 最多读取的字节数（如分段下载的一段），为 None 时读到响应结束
+        onData: 每写入一块数据后调用 onData(字节数)
+    """
+    raw = response.raw
+    fp = getattr(raw, '_fp', None)
+    direct = isinstance(fp, http.client.HTTPResponse)
+    readinto = fp.readinto if direct else raw.readinto
+    buffer = getattr(copyBuffers, 'buffer', None)
+    if buffer is None:
+        buffer = copyBuffers.buffer = memoryview(bytearray(MaxChunkSize))
+    chunkSize = MinChunkSize
+    total = 0
+    while length is None or total < length:
+        size = chunkSize if length is None else min(chunkSize, length - total)
+        startTime = time.monotonic()
+        n = readinto(buffer[:size])
+        if not n:
+            break
+        written = 0
+        while written < n:
+            written += outfh.write(buffer[written:n])
+        total += n
+        if onData:
+            onData(n)
+        elapsed = time.monotonic() - startTime
+        if n == size and elapsed < 0.05:
+            chunkSize = min(MaxChunkSize, chunkSize * 2)
+        elif elapsed > 0.5:
+            chunkSize = max(MinChunkSize, chunkSize // 2)
+    if direct and fp.isclosed():
+        # 绕过了 urllib3 的读取，需要自己把读完的连接还给连接池，否则关闭响应时连接也会被关闭
+        raw.release_conn()
+    return total
+
+
+def preallocate(fh, size):
+    """预先分配文件空间，减少碎片；不支持 posix_fallocate 时只设置文件大小"""
+    try:
+        os.posix_fallocate(fh.fileno(), 0, size)
+    except (AttributeError, OSError):
+        fh.truncate(size)
+
+
+class ProgressReporter:
+    """把下载进度按时间节流后交给 reportProgress(localFile, fileSize, hasRead, speed)
+
+    每收到一块数据只累加字节数，至少间隔 ProgressInterval 秒才调用一次 reportProgress，速度按这段时间计算。
+    多个分段下载线程可以共用一个
+    """
+
+    def __init__(self, reportProgress, localFile, fileSize, hasRead=0):
+        self.__reportProgress = reportProgress
+        self.__localFile = localFile
+        self.__fileSize = fileSize
+        self.__hasRead = hasRead
+        self.__lastRead = hasRead
+        self.__lastTime = time.monotonic()
+        self.__lock = threading.Lock()
+        if reportProgress:
+            reportProgress(localFile, fileSize, hasRead, 0)
+
+    @property
+    def hasRead(self):
+        return self.__hasRead
+
+    def __call__(self, nBytes):
+        with self.__lock:
+            self.__hasRead += nBytes
+            if not self.__reportProgress:
+                return
+            now = time.monotonic()
+            if now - self.__lastTime < ProgressInterval:
+                return
+            report = self.__take(now)
+        self.__reportProgress(*report)
+
+    def __take(self, now):
+        speed = (self.__hasRead - self.__lastRead) / (now - self.__lastTime + 0.0001)
+        self.__lastRead = self.__hasRead
+        self.__lastTime = now
+        return self.__localFile, self.__fileSize, self.__hasRead, speed
+
+    def flush(self):
+        """报告最后的进度"""
+        if self.__reportProgress:
+            with self.__lock:
+                report = self.__take(time.monotonic())
+            self.__reportProgress(*report)
+
+
+def download(session, downloadTask, reportProgress=None, manifest=None, budget=None, segmentThreshold=0,
+             maxSegments=4, stallRetries=3, fsync=False):
+    """下载文件，连接中断或者停顿时重新连接并从断点续传
+
+    停顿指超过会话的读取超时没有收到数据。每次重试前按指数退避等待；
+    上一次连接下载到了新数据时不计入重试次数，连续 stallRetries 次没有进展（或者总共重试了
+    stallRetries * 5 次）才放弃，其它参数见 downloadOnce
+    """
+    failures = 0
+    for attempt in itertools.count():
+        before = downloadedBytes(downloadTask)
+        try:
+            return downloadOnce(session, downloadTask, reportProgress, manifest, budget, segmentThreshold,
+                                maxSegments, fsync)
+        except ResumableErrors + (IncompleteDownloadException,) as e:
+            failures = 0 if downloadedBytes(downloadTask) > before else failures + 1
+            if failures > stallRetries or attempt >= stallRetries * 5:
+                raise
+            debug('下载中断，重新连接后续传: %s (%s)' % (downloadTask.localFile, e))
+            time.sleep(min(0.5 * 2 ** failures, 8))
+
+
+def downloadedBytes(downloadTask):
+    """.part 文件中已经下载好、可以续传的字节数"""
+    partFile = downloadTask.localFile + '.part'
+    info = readPartInfo(partFile, downloadTask.url)
+    if not info:
+        return 0
+    if info.get('preallocated'):
+        return info.get('written', 0)
+    if info.get('segments'):
+        return sum(end - start + 1 for i, (start, end) in enumerate(info['segments']) if i in info['done'])
+    return os.path.getsize(partFile)
+
+
+def downloadOnce(session, downloadTask, reportProgress=None, manifest=None, budget=None, segmentThreshold=0,
+                 maxSegments=4, fsync=False):
+    """下载文件
+
+    数据先写入 localFile.part，下载完成并核对大小后再改名为 localFile。
+    .part 文件已存在时用 Range 请求续传，同时用 If-Range 带上开始下载时的 ETag/Last-Modified，
+    服务器上的文件有变化时会返回完整的文件，此时从头下载，不会把新文件接在旧文件的前半部分之后。
+    从头下载且知道大小时预先分配 .part 文件的空间，此时文件大小不再表示下载到了哪里，
+    每隔 ProgressInterval 秒把已写入的字节数记在 .part.json 中，进程被杀掉后也能从这里续传；
+    正常结束或中断时截掉没有写入的部分
+
+    args:
+        manifest: 同步清单，下载完成后记录文件的校验信息
+        budget: 全局连接名额 ConnectionBudget，调用者已经占用了其中一个
+        segmentThreshold: 大于该大小（字节）的文件分段并发下载，为 0 时不分段
+        maxSegments: 一个文件最多同时使用的连接数
+        fsync: 改名前是否把文件内容写入磁盘
+    """
 
     # 检查目录是否存在
     directory = os.path.split(downloadTask.localFile)[0]
@@ -373,38 +2333,817 @@ def download(session, downloadTask, reportProgress=None):
         except:
             pass
 
-    with session.get(downloadTask.url, stream=True).raw as infh, open(downloadTask.localFile, 'wb') as outfh:
+    partFile = downloadTask.localFile + '.part'
+    partInfo = readPartInfo(partFile, downloadTask.url)
+    if partInfo and partInfo.get('segments'):
+        downloadSegments(session, downloadTask, partInfo, None, reportProgress, manifest, budget, maxSegments,
+                         fsync)
+        return
+
+    # 预先分配了空间却没有截断，说明上次进程异常退出，从记录的已写入位置续传
+    if partInfo and partInfo.get('preallocated'):
+        offset = partInfo.get('written', 0)
+    else:
+        offset = os.path.getsize(partFile) if partInfo else 0
+    validator = partInfo and (partInfo.get('etag') or partInfo.get('lastModified'))
+    if not validator or (partInfo['size'] is not None and offset > partInfo['size']):
+        offset = 0
+
+    headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator} if offset else {}
+    r = session.get(downloadTask.url, stream=True, headers=headers)
+    if offset and r.status_code == 416 and offset == partInfo['size']:
+        # 上次已经下载完，只是没来得及改名
+        r.close()
+        finishDownload(downloadTask, partInfo, manifest, fsync)
+        return
+
+    if offset and (r.status_code != 206 or parseContentRange(r.headers.get('Content-Range')) !=
+                   (offset, partInfo['size'])):
+        r.close()
+        offset = 0
+        r = session.get(downloadTask.url, stream=True)
+    r.raise_for_status()
+    if offset:
+        info = partInfo
+    else:
+        info = {'url': downloadTask.url, 'size': None, 'etag': r.headers.get('ETag'),
+                'lastModified': r.headers.get('Last-Modified')}
         try:
-            fileSize = int(infh.headers.get('Content-Length'))
-        except:
-            fileSize = 0
-        hasRead = 0
-        bufferSize = 102400
-        curTime = time.time()
+            info['size'] = int(r.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            pass
+        if (budget and segmentThreshold and info['size'] and info['size'] > segmentThreshold and
+                r.headers.get('Accept-Ranges') == 'bytes' and (info['etag'] or info['lastModified'])):
+            count = min(maxSegments * 2, -(-info['size'] // (1024 * 1024)))
+            segmentSize = -(-info['size'] // count)
+            info['segments'] = [[start, min(start + segmentSize, info['size']) - 1]
+                                for start in range(0, info['size'], segmentSize)]
+            info['done'] = []
+            # 预先分配文件空间，各分段直接写到自己的位置
+            with open(partFile, 'wb') as fh:
+                preallocate(fh, info['size'])
+            writePartInfo(partFile, info)
+            downloadSegments(session, downloadTask, info, r, reportProgress, manifest, budget, maxSegments,
+                             fsync)
+            return
+        writePartInfo(partFile, info)
+
+    # 最后关闭 r，没有读完的连接也会归还连接池；每次写入的都是大块数据，不需要文件对象的缓冲
+    with contextlib.closing(r), open(partFile, 'r+b' if offset else 'wb', buffering=0) as outfh:
+        if offset:
+            outfh.seek(offset)
+        elif info['size'] and info['size'] > MaxChunkSize:
+            # 小文件一次就能写完，不值得多写两次 .part.json
+            preallocate(outfh, info['size'])
+            info['preallocated'] = True
+            writePartInfo(partFile, info)
+        progress = ProgressReporter(reportProgress, downloadTask.localFile, info['size'] or 0, offset)
+        onData = progress
+        if info.get('preallocated'):
+            marked = [time.monotonic()]
+
+            def onData(nBytes):
+                progress(nBytes)
+                now = time.monotonic()
+                if now - marked[0] >= ProgressInterval:
+                    # 数据已经写入后才记录位置，记录的位置之前一定是下载好的内容
+                    marked[0] = now
+                    info['written'] = outfh.tell()
+                    writePartInfo(partFile, info)
+        try:
+            copyResponse(r, outfh, onData=onData)
+        finally:
+            progress.flush()
+            if info.pop('preallocated', False):
+                info.pop('written', None)
+                outfh.truncate(outfh.tell())
+                writePartInfo(partFile, info)
+
+    if info['size'] is not None and os.path.getsize(partFile) != info['size']:
+        raise IncompleteDownloadException(downloadTask.localFile, os.path.getsize(partFile), info['size'])
+    finishDownload(downloadTask, info, manifest, fsync)
+
+
+def downloadSegments(session, downloadTask, info, firstResponse=None, reportProgress=None, manifest=None,
+                     budget=None, maxSegments=4, fsync=False):
+    """分段并发下载一个大文件
+
+    各分段用 Range 请求并发下载，写入预先分配好空间的 .part 文件中各自的位置，
+    完成的分段记录在 .part.json 中，中断后只需下载未完成的分段。
+    调用者占用的连接名额用于第一个下载线程，其余线程只在 budget 有空闲名额时才启动。
+
+    args:
+        firstResponse: 已经打开的完整文件的响应，用来下载第一个分段
+    """
+    partFile = downloadTask.localFile + '.part'
+    validator = info.get('etag') or info.get('lastModified')
+    lock = threading.Lock()
+    pending = collections.deque(i for i in range(len(info['segments'])) if i not in info['done'])
+    state = {'error': None}
+    helpers = []
+    progress = ProgressReporter(reportProgress, downloadTask.localFile, info['size'],
+                                sum(end - start + 1 for i, (start, end) in enumerate(info['segments'])
+                                    if i in info['done']))
+
+    def fetchSegment(index, response=None):
+        start, end = info['segments'][index]
+        if response is None:
+            response = session.get(downloadTask.url, stream=True,
+                                   headers={'Range': 'bytes=%d-%d' % (start, end), 'If-Range': validator})
+            if response.status_code != 206 or parseContentRange(response.headers.get('Content-Range')) != \
+                    (start, info['size']):
+                response.close()
+                raise RemoteFileChangedException(downloadTask.url)
+        # 第一个分段只读取完整响应的一部分，关闭 response 才会把连接名额归还连接池
+        with contextlib.closing(response), open(partFile, 'r+b', buffering=0) as outfh:
+            outfh.seek(start)
+            remaining = end - start + 1 - copyResponse(response, outfh, end - start + 1, progress)
+        if remaining:
+            raise IncompleteDownloadException(downloadTask.localFile, end - start + 1 - remaining, end - start + 1)
+        with lock:
+            info['done'].append(index)
+            writePartInfo(partFile, info)
+
+    def work(response=None, holdsBudget=False):
+        try:
+            if response is not None:
+                fetchSegment(0, response)
+                response = None
+            while True:
+                with lock:
+                    if not pending or state['error']:
+                        return
+                    index = pending.popleft()
+                fetchSegment(index)
+                spawnHelpers()
+        except Exception as e:
+            with lock:
+                state['error'] = state['error'] or e
+        finally:
+            if response is not None:
+                response.close()
+            if holdsBudget:
+                budget.release()
+
+    def spawnHelpers():
         while True:
-            content = infh.read(bufferSize)
-            outfh.write(content)
-            if reportProgress:
-                lContent = len(content)
-                hasRead += lContent
-                nct = time.time()
-                speed = lContent / (nct - curTime + 0.0001)
-                # cutTime=nct
-                reportProgress(downloadTask.localFile, fileSize, hasRead, speed)
-            if not content:
-                break
-
-
-def downloadAll(session, downloadTasks, reportProgress=None, threadCount=4):
-    """多线程下载文件"""
+            with lock:
+                running = len([t for t in helpers if t.is_alive()])
+                if state['error'] or len(pending) <= running or running >= maxSegments - 1:
+                    return
+            if not budget or not budget.tryAcquire():
+                return
+            t = threading.Thread(target=work, kwargs={'holdsBudget': True}, daemon=True)
+            with lock:
+                helpers.append(t)
+            t.start()
+
+    if firstResponse is not None and 0 in pending:
+        # 第一个分段直接使用已经打开的响应
+        pending.remove(0)
+    elif firstResponse is not None:
+        firstResponse.close()
+        firstResponse = None
+    spawnHelpers()
+    work(firstResponse)
+    for t in list(helpers):
+        t.join()
+    progress.flush()
+
+    if isinstance(state['error'], RemoteFileChangedException):
+        # 服务器上的文件已经改变，丢弃已下载的分段重新下载
+        os.remove(partFile)
+        removePartInfo(partFile)
+        download(session, downloadTask, reportProgress, manifest, fsync=fsync)
+        return
+    if state['error']:
+        raise state['error']
+    if sorted(info['done']) != list(range(len(info['segments']))) or os.path.getsize(partFile) != info['size']:
+        raise IncompleteDownloadException(downloadTask.localFile, progress.hasRead, info['size'])
+    finishDownload(downloadTask, info, manifest, fsync)
+
+
+def finishDownload(downloadTask, info, manifest=None, fsync=False):
+    """把下载完成的 .part 文件改名为正式文件
+
+    args:
+        fsync: 改名前先把文件内容写入磁盘，断电后不会出现大小正确、内容却不完整的文件
+    """
+    partFile = downloadTask.localFile + '.part'
+    if fsync:
+        with open(partFile, 'r+b') as fh:
+            os.fsync(fh.fileno())
+    os.replace(partFile, downloadTask.localFile)
+    removePartInfo(partFile)
+    if manifest:
+        manifest.update(downloadTask.url, downloadTask.localFile,
+                        etag=info['etag'], lastModified=info['lastModified'])
+
+
+def readPartInfo(partFile, url):
+    """读取未完成下载的信息，信息不存在或者不属于 url 时返回 None"""
+    if not os.path.isfile(partFile):
+        return None
+    try:
+        with open(partFile + '.json', encoding='utf8') as fh:
+            info = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    return info if info.get('url') == url else None
+
+
+def writePartInfo(partFile, info):
+    """记录未完成下载的 url、大小和校验信息，用于续传
+
+    先写临时文件再替换，写到一半被中断时不会损坏原来的记录
+    """
+    tmpFile = partFile + '.json.tmp'
+    with open(tmpFile, 'w', encoding='utf8') as fh:
+        json.dump(info, fh)
+    os.replace(tmpFile, partFile + '.json')
+
+
+def removePartInfo(partFile):
+    try:
+        os.remove(partFile + '.json')
+    except OSError:
+        pass
+
+
+def parseContentRange(contentRange):
+    """解析 Content-Range 头，返回 (起始位置, 文件总大小)"""
+    matched = contentRange and re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', contentRange)
+    if not matched:
+        return None
+    total = matched.group(2)
+    return int(matched.group(1)), int(total) if total != '*' else None
+
+
+class ConnectionBudget:
+    """全局连接名额
+
+    文件级的下载线程和大文件的分段下载线程共用，保证同时进行的下载连接数不超过上限
+    """
+
+    def __init__(self, size):
+        self.__semaphore = threading.Semaphore(size)
+
+    @contextlib.contextmanager
+    def hold(self):
+        with self.__semaphore:
+            yield
+
+    def tryAcquire(self):
+        """有空闲名额时占用一个并返回 True，否则立即返回 False"""
+        return self.__semaphore.acquire(blocking=False)
+
+    def release(self):
+        self.__semaphore.release()
+
+
+# 按文件类型排序时各类文件的顺序，其它类型排在文档和音视频之间
+FileTypeWeights = dict([(ext, 0) for ext in ('.pdf', '.ppt', '.pptx', '.doc', '.docx', '.xls', '.xlsx', '.txt',
+                                              '.md', '.html', '.htm', '.caj')] +
+                       [(ext, 2) for ext in ('.mp4', '.avi', '.mkv', '.flv', '.wmv', '.mov', '.rmvb', '.rm',
+                                              '.mp3', '.wav', '.wma', '.iso')])
+
+
+def fileSizeKey(task):
+    return task.size if task.size is not None else float('inf')
+
+
+# 下载顺序 -> 排序键，键相同的任务保持原来的顺序（即课程的优先级顺序）
+DownloadOrders = {
+    'course': lambda task: 0,
+    'size': fileSizeKey,
+    'type': lambda task: (FileTypeWeights.get(os.path.splitext(task.localFile)[1].lower(), 1), fileSizeKey(task)),
+}
+
+
+class DownloadQueue:
+    """按下载顺序排列的任务队列，并限制同时下载的大文件数
+
+    后台线程把 downloadTasks（可以是边抓取边产生任务的生成器）中的任务放入队列，队列中最多有 window 个任务，
+    满了以后等下载线程取走任务再继续读取，不会把生成器一下子读完；排序只在队列中的任务之间进行。
+    下载线程每次取出排在最前面的任务。大于 largeThreshold 的文件最多同时下载 largeSlots 个，
+    名额用完时下载线程先下载后面的小文件，这样几个大视频不会占住所有连接；
+    队列中已经没有小文件、也等不到新的小文件时（所有任务都已得到，或者队列被大文件占满）不再限制，
+    空闲的连接都用来下载大文件
+    """
+
+    def __init__(self, downloadTasks, order='course', largeThreshold=0, largeSlots=1, window=64):
+        """
+        args:
+            order: DownloadOrders 中的下载顺序
+            largeThreshold: 大文件的大小（字节），为 0 时不区分大文件
+            window: 队列中最多预先读取的任务数
+        """
+        self.__key = DownloadOrders[order]
+        self.__largeThreshold = largeThreshold
+        self.__largeSlots = max(1, largeSlots)
+        self.__window = max(1, window)
+        self.__largeRunning = 0
+        self.__small = []
+        self.__large = []
+        self.__sequence = itertools.count()
+        self.__exhausted = False
+        self.__error = None
+        self.__condition = threading.Condition()
+        threading.Thread(target=self.__feed, args=(downloadTasks,), daemon=True).start()
+
+    @property
+    def error(self):
+        """获取任务时（如抓取目录时）发生的错误"""
+        return self.__error
+
+    def isLarge(self, task):
+        return bool(self.__largeThreshold and task.size and task.size > self.__largeThreshold)
+
+    def __feed(self, downloadTasks):
+        try:
+            for task in downloadTasks:
+                with self.__condition:
+                    while self.__isFull():
+                        self.__condition.wait()
+                    heapq.heappush(self.__large if self.isLarge(task) else self.__small,
+                                   (self.__key(task), next(self.__sequence), task))
+                    self.__condition.notify_all()
+        except Exception as e:
+            self.__error = e
+        finally:
+            with self.__condition:
+                self.__exhausted = True
+                self.__condition.notify_all()
+
+    def __isFull(self):
+        return len(self.__small) + len(self.__large) >= self.__window
+
+    def get(self):
+        """取出下一个可以开始的任务，所有任务都已取出时返回 None"""
+        with self.__condition:
+            while True:
+                candidates = [self.__small] if self.__small else []
+                if self.__large and (self.__largeRunning < self.__largeSlots or
+                                     ((self.__exhausted or self.__isFull()) and not self.__small)):
+                    candidates.append(self.__large)
+                if candidates:
+                    heap = min(candidates, key=lambda h: h[0][:2])
+                    task = heapq.heappop(heap)[2]
+                    if heap is self.__large:
+                        self.__largeRunning += 1
+                    # 队列有了空位，让读取任务的线程继续
+                    self.__condition.notify_all()
+                    return task
+                if self.__exhausted:
+                    return None
+                self.__condition.wait()
+
+    def done(self, task):
+        """任务完成（或失败）后调用，归还大文件名额"""
+        if self.isLarge(task):
+            with self.__condition:
+                self.__largeRunning -= 1
+                self.__condition.notify_all()
+
+
+def downloadAll(session, downloadTasks, reportProgress=None, threadCount=4, manifest=None, segmentThreshold=0,
+                maxSegments=4, store=None, order='course', largeThreshold=0, largeSlots=1, fsync=False):
+    """多线程下载文件
+
+    args:
+        segmentThreshold: 大于该大小（字节）的文件分段并发下载，分段和文件共用 threadCount 个连接名额
+        store: 内容仓库 ContentStore，为 None 时不去重
+        order, largeThreshold, largeSlots: 下载顺序和大文件的名额，见 DownloadQueue
+        fsync: 每个文件下载完成后是否写入磁盘再改名
+    """
     ds = []
     for m in downloadTasks:
         ds += m[1]
 
-    pool = Pool(threadCount)
-    pool.map(lambda dd: download(session, dd, reportProgress), ds)
-    pool.close()
-    pool.join()
+    # 任务已经全部得到，整个列表一起排序
+    downloadStream(session, ds, reportProgress, threadCount, manifest, segmentThreshold, maxSegments, store,
+                   order, largeThreshold, largeSlots, fsync, window=len(ds))
+
+
+def downloadStream(session, downloadTasks, reportProgress=None, threadCount=4, manifest=None, segmentThreshold=0,
+                   maxSegments=4, store=None, order='course', largeThreshold=0, largeSlots=1, fsync=False,
+                   window=None):
+    """边获取下载任务边下载
+
+    downloadTasks 可以是生成器，如 Course.iterSyncResourceListOfCourses 的结果，这样第一个文件被发现后就能开始下载。
+    已经得到的任务按 order 排序，下载线程每次取排在最前面的一个，大文件同时最多下载 largeSlots 个（见 DownloadQueue）。
+    最多预先读取 window 个任务（默认是 4 * threadCount），生成器不会被一下子读完，排序只在这些任务之间进行；
+    任务已经全部得到时（如 downloadAll）window 应是任务总数，这样整个列表都按 order 排序。
+    出错的文件不影响其它文件，全部完成后抛出第一个错误。
+    提供 store 时先尝试从仓库中链接相同的文件，下载完成的文件加入仓库
+    """
+    budget = ConnectionBudget(threadCount)
+    tasks = DownloadQueue(downloadTasks, order, largeThreshold, largeSlots, window or 4 * threadCount)
+    errors = []
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            try:
+                with budget.hold():
+                    if store and store.linkDuplicate(session, task, manifest):
+                        continue
+                    download(session, task, reportProgress, manifest, budget, segmentThreshold, maxSegments,
+                             fsync=fsync)
+                if store:
+                    entry = manifest and manifest.get(task.url)
+                    if store.add(task.localFile, entry and entry['etag']) and entry:
+                        # 文件被换成了仓库中的文件，记录新的修改时间，否则下次同步时清单会认为文件在本地被修改过
+                        manifest.update(task.url, task.localFile, entry['size'], entry['etag'], entry['lastModified'])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                tasks.done(task)
+
+    threads = [threading.Thread(target=work, daemon=True) for i in range(threadCount)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if manifest:
+            manifest.save()
+        if store:
+            store.save()
+    if tasks.error:
+        errors.insert(0, tasks.error)
+    if errors:
+        raise errors[0]
+
+
+class TransferMonitor:
+    """下载进度和吞吐量统计
+
+    可以直接作为 download()/downloadAll() 的 reportProgress 使用。速度按最近 window 秒的滑动窗口计算
+    （不使用调用者传入的 speed），分别统计每个文件和全部文件。
+    终端上每 interval 秒刷新一行汇总信息，输出不是终端时改为每 interval 秒输出一行；
+    eventStream 不为 None 时同时写入 JSON Lines 格式的事件，便于接入监控：
+
+        {"event": "start", "time": ..., "file": ..., "size": ...}
+        {"event": "finish", "time": ..., "file": ..., "size": ..., "seconds": ..., "speed": ...}
+        {"event": "summary", "time": ..., "bytes": ..., "speed": ..., "eta": ..., "active": ..., ...}
+    """
+
+    def __init__(self, window=5, interval=0.5, stream=None, eventStream=None, poolStats=None):
+        """
+        args:
+            stream: 显示进度的终端，默认是 sys.stdout，为 False 时不显示
+            eventStream: 写入 JSON Lines 事件的文件对象
+            poolStats: 连接池统计 PoolStats，用于显示正在使用的连接数
+        """
+        self.__window = window
+        self.__interval = interval
+        self.__stream = sys.stdout if stream is None else stream
+        self.__eventStream = eventStream
+        self.__poolStats = poolStats
+        self.__lock = threading.Lock()
+        self.__startTime = time.time()
+        self.__lastReport = 0
+        self.__lineWidth = 0
+        self.__totalBytes = 0
+        self.__totalFiles = 0
+        self.__bytes = 0
+        self.__finished = 0
+        self.__samples = collections.deque()
+        # 文件名 -> {'size', 'hasRead', 'startTime', 'startRead', 'samples'}
+        self.__files = collections.OrderedDict()
+        # 已完成的文件名 -> 大小，用来忽略完成后最后一次的进度报告
+        self.__done = {}
+
+    def expect(self, nBytes, nFiles=1):
+        """登记将要下载的字节数和文件数，用于计算总进度和剩余时间"""
+        with self.__lock:
+            self.__totalBytes += nBytes or 0
+            self.__totalFiles += nFiles
+
+    def expectTasks(self, downloadTasks):
+        for task in downloadTasks:
+            self.expect(task.size)
+
+    def __call__(self, localFile, fileSize, hasRead, speed=None):
+        now = time.time()
+        events = []
+        with self.__lock:
+            if localFile in self.__done and hasRead >= self.__done[localFile]:
+                return
+            self.__done.pop(localFile, None)
+            f = self.__files.get(localFile)
+            if f is None:
+                f = self.__files[localFile] = {'size': fileSize, 'hasRead': hasRead, 'startTime': now,
+                                               'startRead': hasRead, 'samples': collections.deque()}
+                events.append({'event': 'start', 'file': localFile, 'size': fileSize, 'offset': hasRead})
+            self.__bytes += max(0, hasRead - f['hasRead'])
+            f['hasRead'] = max(f['hasRead'], hasRead)
+            self.__addSample(f['samples'], now, f['hasRead'])
+            self.__addSample(self.__samples, now, self.__bytes)
+            if fileSize and f['hasRead'] >= fileSize:
+                events.append(self.__finish(localFile, now))
+            if now - self.__lastReport >= self.__interval:
+                self.__lastReport = now
+                summary = self.__snapshot(now)
+            else:
+                summary = None
+        for event in events:
+            self.__emit(event, now)
+        if summary:
+            self.__emit(dict(summary, event='summary'), now)
+            self.__display(summary)
+
+    def __addSample(self, samples, now, value):
+        # 每 0.1 秒最多记录一个采样点，窗口外的采样点只保留一个作为起点
+        if samples and now - samples[-1][0] < 0.1:
+            samples[-1] = (samples[-1][0], value)
+        else:
+            samples.append((now, value))
+        while len(samples) > 2 and samples[1][0] <= now - self.__window:
+            samples.popleft()
+
+    @staticmethod
+    def __speed(samples, now, value):
+        if not samples or now - samples[0][0] <= 0:
+            return 0
+        return (value - samples[0][1]) / (now - samples[0][0])
+
+    def __finish(self, localFile, now):
+        f = self.__files.pop(localFile)
+        self.__done[localFile] = f['hasRead']
+        self.__finished += 1
+        seconds = now - f['startTime']
+        nBytes = f['hasRead'] - f['startRead']
+        return {'event': 'finish', 'file': localFile, 'size': f['size'], 'seconds': seconds,
+                'speed': nBytes / seconds if seconds > 0 else 0}
+
+    def __snapshot(self, now):
+        speed = self.__speed(self.__samples, now, self.__bytes)
+        remaining = self.__totalBytes - self.__bytes
+        return {
+            'bytes': self.__bytes,
+            'totalBytes': self.__totalBytes,
+            'speed': speed,
+            'eta': remaining / speed if speed > 0 and remaining > 0 else None,
+            'finished': self.__finished,
+            'totalFiles': self.__totalFiles,
+            'active': self.__poolStats.active if self.__poolStats else len(self.__files),
+            'elapsed': now - self.__startTime,
+            'files': [{'file': name, 'size': f['size'], 'hasRead': f['hasRead'],
+                       'speed': self.__speed(f['samples'], now, f['hasRead'])}
+                      for name, f in self.__files.items()],
+        }
+
+    def snapshot(self):
+        """当前的统计信息"""
+        with self.__lock:
+            return self.__snapshot(time.time())
+
+    def emit(self, event):
+        """写入一个其它来源的事件，如监视模式发现的新课件"""
+        self.__emit(dict(event), time.time())
+
+    def __emit(self, event, now):
+        if self.__eventStream:
+            event['time'] = now
+            with self.__lock:
+                self.__eventStream.write(json.dumps(event, ensure_ascii=False) + '\n')
+                self.__eventStream.flush()
+
+    def __display(self, s, final=False):
+        if not self.__stream:
+            return
+        line = '[{}/{}] {}/{} {}/s 剩余 {} 连接 {}'.format(
+            s['finished'], s['totalFiles'] or '?', formatSize(s['bytes']), formatSize(s['totalBytes']) if s['totalBytes'] else '?',
+            formatSize(s['speed']), formatDuration(s['eta']), s['active'])
+        if s['files']:
+            line += ' | ' + ', '.join('{}({}%)'.format(os.path.basename(f['file']),
+                                                        int(f['hasRead'] * 100 / f['size']) if f['size'] else '?')
+                                      for f in s['files'][:3])
+        with self.__lock:
+            if self.__stream.isatty():
+                self.__stream.write('\r' + line.ljust(self.__lineWidth) + ('\n' if final else ''))
+                self.__lineWidth = len(line)
+            else:
+                self.__stream.write(line + '\n')
+            self.__stream.flush()
+
+    def log(self, message):
+        """输出一行信息，不和进度行混在一起"""
+        if not self.__stream:
+            return
+        with self.__lock:
+            if self.__lineWidth and self.__stream.isatty():
+                self.__stream.write('\r' + ' ' * self.__lineWidth + '\r')
+                self.__lineWidth = 0
+            self.__stream.write(message + '\n')
+            self.__stream.flush()
+
+    def close(self):
+        """输出最后的汇总信息，没有大小的文件在这里记为完成"""
+        now = time.time()
+        with self.__lock:
+            events = [self.__finish(name, now) for name in list(self.__files)]
+            summary = self.__snapshot(now)
+            # 整个过程的平均速度比最后一个窗口更有意义
+            summary['speed'] = summary['bytes'] / summary['elapsed'] if summary['elapsed'] > 0 else 0
+        for event in events:
+            self.__emit(event, now)
+        self.__emit(dict(summary, event='done'), now)
+        self.__display(summary, True)
+
+
+class CourseWatcher:
+    """监视模式：定时检查课程的课件目录和作业列表，自动下载新的课件和作业附件
+
+    每个课程有自己的检查间隔：发现新内容后缩短为 minInterval，之后每次没有变化就加倍，最长为 maxInterval；
+    以前学期的课程一开始就是 maxInterval。正在上的课程检查得勤，已经结课的课程很少检查，请求数就少了。
+    同时到期的课程一起检查，课件目录由同一个 ResourceCrawler 抓取，通过 ListingCache 对目录页面发送条件请求，
+    没有变化的目录中的文件不再查询；作业列表中没有变化的作业不再请求详情页。
+    两次检查之间每隔 keepAlive 秒访问一次 SEP，会话不会因为长时间没有请求而失效。
+
+    发现的新内容和每次检查的结果以事件的形式交给 onEvent(event)：
+
+        {"event": "new-file", "course": ..., "file": ..., "size": ...}
+        {"event": "new-homework", "course": ..., "name": ..., "status": ..., "dueDate": ...}
+        {"event": "homework-changed", "course": ..., "name": ..., "status": ..., "dueDate": ...}
+        {"event": "poll", "courses": [...], "changed": [...], "seconds": ...}
+        {"event": "error", "courses": [...], "error": ...}
+    """
+
+    def __init__(self, ucas, courses, localDir, download=None, onEvent=None, blackList=None, manifest=None,
+                 minInterval=600, maxInterval=6 * 3600, keepAlive=600, threadCount=4, listingCache=None):
+        """
+        args:
+            download: 下载函数 download([(课程名, [DownloadTask, ...]), ...])，为 None 时只报告不下载
+            blackList: 课件黑名单（正则表达式）
+            manifest: 同步清单 SyncManifest
+            minInterval, maxInterval: 每个课程检查间隔的范围（秒）
+            keepAlive: 访问 SEP 保持会话的间隔（秒），为 0 时不访问
+            listingCache: 目录页面的缓存 ListingCache，为 None 时新建一个
+        """
+        self.__ucas = ucas
+        self.__courses = list(courses)
+        self.__localDir = localDir
+        self.__download = download
+        self.__onEvent = onEvent or (lambda event: None)
+        self.__blackList = blackList
+        self.__manifest = manifest
+        self.__minInterval = minInterval
+        self.__maxInterval = maxInterval
+        self.__keepAlive = keepAlive
+        self.__threadCount = threadCount
+        self.__listingCache = listingCache or ListingCache()
+        self.__stopped = threading.Event()
+        latest = max((c.term for c in self.__courses if c.term), default=None)
+        # 课程地址 -> 当前的检查间隔，第一次检查相当于一次完整的同步，不改变间隔
+        self.__intervals = {c.url: minInterval if c.term is None or c.term == latest else maxInterval
+                            for c in self.__courses}
+        self.__polled = set()
+        # 课程地址 -> {(作业名, 开始日期): (状态, 截止日期)}，第一次检查时只记录，之后的变化才作为事件
+        self.__homework = {}
+
+    @property
+    def listingCache(self):
+        return self.__listingCache
+
+    def interval(self, course):
+        """课程当前的检查间隔（秒）"""
+        return self.__intervals[course.url]
+
+    def stop(self):
+        """让 run() 尽快返回，正在进行的检查会先完成"""
+        self.__stopped.set()
+
+    def run(self):
+        """一直检查直到调用 stop()，第一次检查所有课程"""
+        now = time.monotonic()
+        due = [(now, i) for i in range(len(self.__courses))]
+        nextKeepAlive = now + self.__keepAlive
+        while due and not self.__stopped.is_set():
+            now = time.monotonic()
+            if due[0][0] > now:
+                wakeUp = min(due[0][0], nextKeepAlive) if self.__keepAlive else due[0][0]
+                if self.__stopped.wait(wakeUp - now):
+                    return
+                if self.__keepAlive and time.monotonic() >= nextKeepAlive:
+                    self.keepAlive()
+                    nextKeepAlive = time.monotonic() + self.__keepAlive
+                continue
+            indexes = []
+            while due and due[0][0] <= now:
+                indexes.append(heapq.heappop(due)[1])
+            self.poll([self.__courses[i] for i in indexes])
+            now = time.monotonic()
+            for i in indexes:
+                heapq.heappush(due, (now + self.__intervals[self.__courses[i].url], i))
+            nextKeepAlive = now + self.__keepAlive
+
+    def keepAlive(self):
+        """访问 SEP 使会话保持有效，会话已经失效时抛出 SessionExpiredException"""
+        try:
+            if not self.__ucas.isLoggedIn():
+                raise SessionExpiredException()
+        except requests.RequestException as e:
+            self.__onEvent({'event': 'error', 'courses': [], 'error': str(e)})
+
+    def poll(self, courses=None):
+        """检查一次课程，下载新内容并调整这些课程的检查间隔
+
+        检查出错时报告 error 事件，检查间隔不变
+
+        return:
+            发现了新内容的课程名列表
+        """
+        courses = self.__courses if courses is None else list(courses)
+        names = [c.name for c in courses]
+        startTime = time.monotonic()
+        try:
+            downloadList, changed = self.__check(courses)
+            if downloadList and self.__download:
+                self.__download(downloadList)
+        except Exception as e:
+            debug('检查课程出错: %r' % e)
+            self.__onEvent({'event': 'error', 'courses': names, 'error': str(e)})
+            return []
+        finally:
+            # 每次检查后都保存，程序被终止时不会丢失
+            if self.__manifest:
+                self.__manifest.save()
+            self.__ucas.saveCache()
+            self.__ucas.saveSession()
+        for c in courses:
+            if c.url in self.__polled:
+                interval = self.__intervals[c.url]
+                self.__intervals[c.url] = self.__minInterval if c.name in changed else \
+                    min(interval * 2, self.__maxInterval)
+            self.__polled.add(c.url)
+        changed = [name for name in names if name in changed]
+        self.__onEvent({'event': 'poll', 'courses': names, 'changed': changed,
+                        'seconds': time.monotonic() - startTime})
+        return changed
+
+    def __check(self, courses):
+        """抓取课件目录和作业，返回 (需要下载的列表, 有新内容的课程名集合)"""
+        session = self.__ucas.session
+        # 批量元数据每次检查都重新获取，只有目录有变化、需要查询文件时才会请求
+        crawler = ResourceCrawler(session, self.__threadCount, self.__threadCount, manifest=self.__manifest,
+                                  metadata=MetadataSource(session), blackList=self.__blackList,
+                                  listingCache=self.__listingCache)
+        fileLists = crawler.crawl([(c.resourceUrl, c.name) for c in courses])
+        homework = dict((c.url, h) for c, h in Course.getHomeworkOfCourses(
+            [c for c in courses if '课堂作业' in c.courseToolUrls], self.__threadCount))
+
+        downloadList = []
+        changed = set()
+        for c, fileList in zip(courses, fileLists):
+            tasks = c.getSyncResourceList(self.__localDir, None, fileList, self.__manifest)
+            if c.url in homework:
+                if self.__checkHomework(c, homework[c.url]):
+                    changed.add(c.name)
+                tasks += c.getHomeworkSyncList(self.__localDir, homework[c.url], self.__manifest)
+            for task in tasks:
+                self.__onEvent({'event': 'new-file', 'course': c.name, 'file': task.localFile, 'size': task.size})
+            if tasks:
+                changed.add(c.name)
+                downloadList.append((c.name, tasks))
+        return downloadList, changed
+
+    def __checkHomework(self, course, homework):
+        """和上次检查的作业列表比较，报告新的和状态、截止日期有变化的作业，返回是否有变化"""
+        rows = collections.OrderedDict(((h.name, h.openDate), (h.status, h.dueDate)) for h in homework)
+        known = self.__homework.get(course.url)
+        self.__homework[course.url] = rows
+        if known is None:
+            return False
+        events = [{'event': 'new-homework' if key not in known else 'homework-changed', 'course': course.name,
+                   'name': key[0], 'status': row[0], 'dueDate': row[1]}
+                  for key, row in rows.items() if known.get(key) != row]
+        for event in events:
+            self.__onEvent(event)
+        return bool(events)
+
+
+def formatSize(n):
+    """把字节数格式化为便于阅读的大小"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return '%.1f%s' % (n, unit)
+        n /= 1024
+    return '%.1fTB' % n
+
+
+def formatDuration(seconds):
+    """把秒数格式化为 [时:]分:秒"""
+    if seconds is None:
+        return '--:--'
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d' % (h, m, s) if h else '%02d:%02d' % (m, s)
 
 
 def reportDownloadProgress(localFile, fileSize, hasRead, speed):
@@ -415,6 +3154,95 @@ def reportDownloadProgress(localFile, fileSize, hasRead, speed):
                                                  int(speed / 1024)))
 
 
+def createMonitor(ucas, opts):
+    """根据命令行选项创建下载进度统计"""
+    if opts.events == '-':
+        return TransferMonitor(stream=False, eventStream=sys.__stdout__, poolStats=ucas.session.stats)
+    eventStream = open(opts.events, 'a', encoding='utf8') if opts.events else None
+    return TransferMonitor(eventStream=eventStream, poolStats=ucas.session.stats)
+
+
+def confirmAndDownload(ucas, downloadList, opts, manifest, store=None):
+    """显示需要下载的资源列表，确认后下载
+
+    return:
+        是否已完成同步（只显示列表或者用户取消时为 False）
+    """
+    if len(downloadList) > 0:
+        print('需要下载的资源列表如下：')
+        for c, rs in downloadList:
+            print('课程: %s' % (c,))
+            for r in rs:
+                print(r.localFile)
+
+        if opts.dryRun:
+            return False
+        if not opts.yes:
+            i = input('是否下载? (y/n)')
+            if i.lower() != 'y':
+                return False
+
+        print('开始下载...')
+        monitor = createMonitor(ucas, opts)
+        for c, rs in downloadList:
+            monitor.expectTasks(rs)
+        try:
+            downloadAll(ucas.session, downloadList, monitor, opts.threads, manifest,
+                        opts.segmentThreshold * 1024 * 1024, store=store, order=opts.order,
+                        largeThreshold=opts.largeFile * 1024 * 1024, largeSlots=opts.largeSlots, fsync=opts.fsync)
+        finally:
+            monitor.close()
+            reportStore(store)
+        debug('连接池统计: %s' % ucas.poolStats)
+    return True
+
+
+def watchCourses(ucas, courses, localDir, opts, manifest, store=None, threadCount=4):
+    """监视模式：一直运行，定时检查课程并自动下载新内容，按 Ctrl-C 停止"""
+    monitor = createMonitor(ucas, opts)
+    messages = {'new-file': '课程: {course} 新资源: {file}',
+                'new-homework': '课程: {course} 新作业: {name}（{status}，截止 {dueDate}）',
+                'homework-changed': '课程: {course} 作业有变化: {name}（{status}，截止 {dueDate}）',
+                'error': '检查出错: {error}'}
+
+    def onEvent(event):
+        monitor.emit(event)
+        if event['event'] in messages:
+            monitor.log(messages[event['event']].format(**event))
+        elif event['changed']:
+            debug('检查了 %d 门课程，有新内容: %s' % (len(event['courses']), '、'.join(event['changed'])))
+
+    def download(downloadList):
+        for c, rs in downloadList:
+            monitor.expectTasks(rs)
+        downloadAll(ucas.session, downloadList, monitor, opts.threads, manifest,
+                    opts.segmentThreshold * 1024 * 1024, store=store, order=opts.order,
+                    largeThreshold=opts.largeFile * 1024 * 1024, largeSlots=opts.largeSlots, fsync=opts.fsync)
+
+    watcher = CourseWatcher(ucas, courses, localDir, None if opts.dryRun else download, onEvent,
+                            opts.blacklist.split() if opts.blacklist else None, manifest,
+                            opts.minInterval * 60, opts.maxInterval * 60, threadCount=threadCount)
+    print('开始监视 %d 门课程，按 Ctrl-C 停止' % len(courses))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print('\n停止监视')
+    finally:
+        monitor.close()
+        reportStore(store)
+        debug('目录页面缓存统计: %s' % watcher.listingCache.stats)
+
+
+def reportStore(store):
+    """输出去重节省的下载量和磁盘空间"""
+    if not store:
+        return
+    stats = store.stats
+    if stats['linked'] or stats['deduplicated']:
+        print('去重: {} 个文件直接链接，少下载 {}；{} 个文件下载后合并，节省磁盘 {}'.format(
+            stats['linked'], formatSize(stats['bytesSaved']), stats['deduplicated'], formatSize(stats['diskSaved'])))
+
+
 def main():
 
     # 解析命令行选项
@@ -422,17 +3250,72 @@ def main():
     usage = "usage: %prog [options] courseNamePattern1 courseNamePattern2 ..."
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-a', '--action', dest='action', default='sync',
-                      help='指定进行的操作。sync:同步课件;\nstudent:学生列表\nhomework:作业信息')
+                      help='指定进行的操作。sync:同步课件;\nstudent:学生列表\nhomework:作业信息\n'
+                           'homework-sync:下载作业附件')
     parser.add_option('-y', '--yes', action='store_true', default=False, dest='yes',
                       help='对所有询问回答"是"')
     parser.add_option('-d', '--dir', dest='dir', default=None,
                       help='指定课件存放的目录')
     parser.add_option('-b', '--blacklist', dest='blacklist', default=None,
                       help='指定不进行同步的课件黑名单, 可使用正则表达式指定(如"\.mp4"指定不下载视频)')
+    parser.add_option('--all', dest='all', action='store_true', default=False,
+                      help='选择所有学期的所有课程，不需要指定课程名')
+    parser.add_option('--priority', dest='priority', default='recent', choices=['recent', 'order'],
+                      help='多门课程的同步顺序。recent:新学期的课程在前;\norder:按命令行中课程名的顺序，默认是 %default')
     parser.add_option('-c', '--classmate', dest='classmate', action='store_true', default=False,
                       help='只显示同班同学的学生列表')
+    parser.add_option('--min-shared', dest='minShared', type='int', default=0,
+                      help='列出和你至少一起上这么多门课的同学，为 0 时按课程显示学生列表，默认是 %default')
+    parser.add_option('-t', '--threads', dest='threads', type='int', default=4,
+                      help='同时进行的抓取和下载连接数，默认是 %default')
+    parser.add_option('--max-concurrency', dest='maxConcurrency', type='int', default=16,
+                      help='根据服务器的延迟和错误率自动调整并发请求数，最多到该值，为 0 时固定使用 -t 指定的数目，'
+                           '默认是 %default')
+    parser.add_option('--rate', dest='rate', type='float', default=0,
+                      help='每秒最多发出的请求数，为 0 时不限制，默认是 %default')
+    parser.add_option('--timeout', dest='timeout', type='float', default=30,
+                      help='请求超时（秒），下载时超过该时间没有收到数据会重新连接并续传，默认是 %default')
+    parser.add_option('--hedge-delay', dest='hedgeDelay', type='float', default=1,
+                      help='目录页面超过该时间（秒）且比最近 95% 的请求都慢时再发一个相同的请求，为 0 时不发送，'
+                           '默认是 %default')
+    parser.add_option('--segment-threshold', dest='segmentThreshold', type='int', default=64,
+                      help='大于该大小（MB）的文件分段并发下载，为 0 时不分段，默认是 %default')
+    parser.add_option('--order', dest='order', default='course', choices=sorted(DownloadOrders),
+                      help='下载顺序。course:按课程的优先级（见 --priority）;\nsize:小文件在前;\ntype:文档在前、音视频在后，'
+                           '默认是 %default')
+    parser.add_option('--large-file', dest='largeFile', type='int', default=32,
+                      help='大于该大小（MB）的文件算作大文件，为 0 时不区分，默认是 %default')
+    parser.add_option('--large-slots', dest='largeSlots', type='int', default=1,
+                      help='同时下载的大文件数，其余连接先下载小文件，默认是 %default')
+    parser.add_option('--fsync', dest='fsync', action='store_true', default=False,
+                      help='每个文件下载完成后先写入磁盘再改名，断电时不会留下内容不完整的文件（会慢一些）')
+    parser.add_option('-p', '--pipeline', dest='pipeline', action='store_true', default=False,
+                      help='边抓取边下载，不再询问是否下载')
+    parser.add_option('-w', '--watch', dest='watch', action='store_true', default=False,
+                      help='一直运行，定时检查课件和作业并自动下载新内容，不再询问是否下载，按 Ctrl-C 停止')
+    parser.add_option('--min-interval', dest='minInterval', type='float', default=10,
+                      help='监视时有新内容的课程的检查间隔（分钟），默认是 %default')
+    parser.add_option('--max-interval', dest='maxInterval', type='float', default=360,
+                      help='监视时课程没有变化的次数越多检查得越少，最长的检查间隔（分钟），默认是 %default')
+    parser.add_option('-n', '--dry-run', dest='dryRun', action='store_true', default=False,
+                      help='只显示需要下载的资源列表，不进行下载')
+    parser.add_option('--dedup', dest='dedup', action='store_true', default=False,
+                      help='在同步目录下的 .ucas_store 中按内容保存课件，相同的课件只下载和保存一次（使用硬链接）')
+    parser.add_option('--events', dest='events', default=None,
+                      help='把下载事件以 JSON Lines 格式追加到该文件，为 - 时输出到标准输出（其它信息改为输出到标准错误，不显示进度行）')
+    parser.add_option('--refresh', dest='refresh', action='store_true', default=False,
+                      help='不使用缓存的课程列表、工具链接和用户信息，重新获取')
+    parser.add_option('--cache-ttl', dest='cacheTtl', type='int', default=24,
+                      help='课程列表、工具链接和用户信息的缓存时间（小时），为 0 时不缓存，默认是 %default')
+    parser.add_option('--no-session', dest='saveSession', action='store_false', default=True,
+                      help='不保存登录状态，每次运行都输入验证码')
+    parser.add_option('--manifest-trust', dest='manifestTrust', type='int', default=0,
+                      help='同步清单中的文件在检查后多少秒内不再向服务器确认，默认是 %default')
 
     opts, args = parser.parse_args()  # (['-d', '/Volumes/Buffer/Course/Sync', '自然语言处理', '夏季'])
+    if opts.events == '-':
+        # 标准输出只留给 JSON Lines 事件，其它信息输出到标准错误
+        sys.stdout = sys.stderr
 
     # print(opts)
 
@@ -448,54 +3331,144 @@ def main():
     syncDir = opts.dir or config.get('dir', None) or '.'
 
     # work
-    ucas = UCAS()
-    r, error = ucas.login(username, password)
+    # 下载最多使用 opts.threads 个连接；抓取的线程数是并发上限，实际的并发数由 AdaptiveConcurrency 调整
+    concurrency = AdaptiveConcurrency(opts.threads, 1, opts.maxConcurrency) if opts.maxConcurrency > 0 else None
+    crawlThreads = concurrency.maximum if concurrency else opts.threads
+    cache = DiskCache.forUser(username, opts.cacheTtl * 3600) if opts.cacheTtl > 0 else None
+    cookieStore = CookieStore.forUser(username) if opts.saveSession else None
+    # 对冲请求最多同时有两个，连接池多留两个连接
+    ucas = UCAS(poolSize=max(crawlThreads, opts.threads) + 4, cache=cache, cookieStore=cookieStore,
+                concurrency=concurrency, rate=opts.rate, timeout=(min(10, opts.timeout), opts.timeout),
+                hedgeDelay=opts.hedgeDelay)
+    if opts.refresh:
+        ucas.invalidateCache()
+    # 没有终端时（如定时任务）无法输入验证码
+    r, error = ucas.login(username, password, sys.stdin.isatty())
     if not r:
         raise Exception(error)
-    courseList = ucas.getMatchedCourses(*args) if len(args) > 0 else ucas.getCoursesOfCurrentTerm()
-    if opts.action == 'sync':
-        debug(courseList)
-        downloadList = Course.getSyncResourceListOfCourses(courseList, syncDir,
-                                                           opts.blacklist.splits() if opts.blacklist else None)
-
-        if len(downloadList) > 0:
-            print('需要下载的资源列表如下：')
-            for c, rs in downloadList:
-                print('课程: %s' % (c,))
-                for r in rs:
-                    print(r.localFile)
-
-            if not opts.yes:
-                i = input('是否下载? (y/n)')
-                if i.lower() != 'y':
-                    return
+    try:
+        # 多个课程名或 --all 时所有课程共用同一个会话、抓取线程池和下载线程池，按优先级依次进行
+        if args or opts.all:
+            courseList = ucas.getBatchCourses(args, opts.priority)
+        else:
+            courseList = ucas.getCoursesOfCurrentTerm()
+        if opts.action == 'sync':
+            debug(courseList)
+            manifest = SyncManifest(syncDir, opts.manifestTrust)
+            store = ContentStore(syncDir) if opts.dedup else None
+            if opts.watch:
+                watchCourses(ucas, courseList, syncDir, opts, manifest, store, crawlThreads)
+                if store and not opts.dryRun:
+                    store.prune()
+                    store.save()
+                return
+            if opts.pipeline and not opts.dryRun:
+                print('边抓取边下载...')
+                tasks = Course.iterSyncResourceListOfCourses(courseList, syncDir,
+                                                             opts.blacklist.split() if opts.blacklist else None,
+                                                             crawlThreads, crawlThreads, manifest=manifest)
+
+                monitor = createMonitor(ucas, opts)
+
+                def announce():
+                    for c, task in tasks:
+                        monitor.log('课程: %s 新资源: %s' % (c, task.localFile))
+                        monitor.expect(task.size)
+                        yield task
+
+                try:
+                    downloadStream(ucas.session, announce(), monitor, opts.threads, manifest,
+                                   opts.segmentThreshold * 1024 * 1024, store=store, order=opts.order,
+                                   largeThreshold=opts.largeFile * 1024 * 1024, largeSlots=opts.largeSlots,
+                                   fsync=opts.fsync)
+                finally:
+                    monitor.close()
+                    reportStore(store)
+                debug('连接池统计: %s' % ucas.poolStats)
+                print('同步完成')
+                if store:
+                    store.prune()
+                    store.save()
+                return
+
+            downloadList = Course.getSyncResourceListOfCourses(courseList, syncDir,
+                                                               opts.blacklist.split() if opts.blacklist else None,
+                                                               crawlThreads, crawlThreads, manifest=manifest)
+            debug('HEAD 请求统计: %s' % ucas.metadata.stats)
+            if confirmAndDownload(ucas, downloadList, opts, manifest, store):
+                print('同步完成')
+            if store and not opts.dryRun:
+                store.prune()
+                store.save()
+
+        elif opts.action == 'homework-sync':
+            manifest = SyncManifest(syncDir, opts.manifestTrust)
+            store = ContentStore(syncDir) if opts.dedup else None
+            downloadList = Course.getHomeworkSyncListOfCourses(courseList, syncDir, crawlThreads, manifest)
+            if confirmAndDownload(ucas, downloadList, opts, manifest, store):
+                print('作业附件同步完成')
+
+        elif opts.action == 'student':
+            # 所有课程的名单并发获取，按学期缓存，再建立一次索引用于查询
+            index = ucas.getRosterIndex(courseList, crawlThreads)
+            if opts.minShared > 0:
+                print('和你至少一起上 %d 门课的同学:' % opts.minShared)
+                for studentId, name, shared in index.classmates(ucas.userInfo[1], opts.minShared):
+                    print((studentId, name), '、'.join(shared))
+            else:
+                classmates = None
+                if opts.classmate:
+                    userId = ucas.userInfo[1]
+                    patterned = ''.join((userId[0:4], '[2e]', userId[5:12]))
+                    classmates = {s[0] for s in index.match(patterned)}
+                for c in courseList:
+                    print('课程: %s' % (c.name,))
+                    ss = [s for s in c.students
+                          if classmates is None or index.normalizeId(s[0]) in classmates]
+                    print(*ss, sep='\n')
+
+        elif opts.action == 'homework':
+            for c, ss in Course.getHomeworkOfCourses(courseList, crawlThreads):
+                print('课程: %s' % (c.name,))
+                print(*ss)
+
+    finally:
+        # 已获取的课程列表、工具链接和会话留给下次运行使用
+        ucas.saveCache()
+        ucas.saveSession()
+        if concurrency:
+            debug('并发控制统计: %s' % concurrency.stats)
 
-            print('开始下载...')
-            downloadAll(ucas.session, downloadList, reportDownloadProgress)
-        print('同步完成')
 
-    elif opts.action == 'student':
-        for c in courseList:
-            print('课程: %s' % (c.name,))
+class NoConfigFileException(Exception):
+    def __str__(self):
+        return '配置文件不存在！'
 
-            if not opts.classmate:
-                ss = c.students
-            else:
-                userId = ucas.userInfo[1]
-                patterned = ''.join((userId[0:4], '[2e]', userId[5:12]))
-                ss = c.getMatchedStudents(patterned)
-            print(*ss, sep='\n')
 
-    elif opts.action == 'homework':
-        for c in courseList:
-            print('课程: %s' % (c.name,))
-            ss = c.homework
-            print(*ss)
+class SessionExpiredException(Exception):
+    def __str__(self):
+        return '登录状态已失效，需要重新运行并输入验证码'
 
 
-class NoConfigFileException(Exception):
+class CrawlCancelledException(Exception):
     def __str__(self):
-        return '配置文件不存在！'
+        return '抓取已被取消'
+
+
+class RemoteFileChangedException(Exception):
+    def __str__(self):
+        return '服务器上的文件在下载过程中发生了变化：{}'.format(self.args[0])
+
+
+class IncompleteDownloadException(Exception):
+    def __init__(self, localFile, hasRead, fileSize):
+        super().__init__(localFile, hasRead, fileSize)
+        self.localFile = localFile
+        self.hasRead = hasRead
+        self.fileSize = fileSize
+
+    def __str__(self):
+        return '文件下载不完整：{}（{}/{} 字节），再次同步时会继续下载'.format(self.localFile, self.hasRead, self.fileSize)
 
 
 def test():
@@ -0,0 +1,551 @@
+#! /usr/bin/env python3
+
+"""模拟 SEP 和课程网站（Sakai）的本地服务器
+
+以 HTTP 代理的方式工作：客户端把 http://sep.ucas.ac.cn 和 http://course.ucas.ac.cn 的请求都发给它，
+UCASCourse.py 不需要做任何修改就可以离线运行。模拟的内容包括：
+
+* SEP 的登录页、验证码和登录
+* 课程网站的身份跳转、mainFrame、工具栏、"我的课程"、"我的信息"
+* 每个课程的工具页、应用统计、课堂作业
+* access/content/group/<siteId>/ 目录树和文件（支持 HEAD、Range、If-Range、If-None-Match，目录页面也有 ETag）
+* /direct/content/site/<siteId>.json 批量元数据接口
+
+课程数、目录深度、文件数和大小、每个请求的延迟以及下载带宽都可以配置。
+访问 http://mock.local/__stats 返回请求数和发送的字节数，/__reset 清零统计。
+开启 requireLogin 时课程网站的请求需要带上进入课程网站时设置的 Cookie，否则重定向到 SEP；
+进入课程网站也需要 SEP 登录后设置的 Cookie。/__expire 使所有课程网站的会话失效，/__expire?sep=1 同时使 SEP 的会话失效。
+/__add?site=<siteId> 在课程根目录下增加一个文件，/__add?site=<siteId>&homework=1 增加一次作业，用于测试监视模式
+
+usage: python MockSakaiServer.py [options]
+"""
+
+import hashlib
+import http.cookies
+import http.server
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+SepHost = 'sep.ucas.ac.cn'
+CourseHost = 'course.ucas.ac.cn'
+LastModified = 'Mon, 01 Feb 2016 08:00:00 GMT'
+SakaiModifiedDate = '20160201080000000'
+Tools = ['课程资源', '课堂作业', '应用统计', '公告', '日程表']
+
+
+class MockConfig:
+    """模拟数据的配置"""
+
+    def __init__(self, courses=4, depth=2, folders=2, files=10, fileSize=200 * 1024, videos=0,
+                 videoSize=50 * 1024 * 1024, students=100, homework=5, latency=0.02, bandwidth=0, contentApi=True,
+                 requireLogin=False, capacity=0, shared=0, stalls=0, stallTime=60):
+        """
+        args:
+            courses: 课程数
+            depth: 目录深度，0 表示只有根目录
+            folders: 每个目录下的子目录数
+            files: 每个目录下的文件数
+            fileSize: 普通文件的大小（字节）
+            videos: 每个课程根目录下的大文件数
+            videoSize: 大文件的大小（字节）
+            students: 每个课程的学生数
+            homework: 每个课程的作业数
+            latency: 每个请求的延迟（秒）
+            bandwidth: 每个连接的下载带宽（字节/秒），为 0 时不限制
+            contentApi: 是否提供批量元数据接口
+            requireLogin: 课程网站是否检查会话 Cookie
+            capacity: 服务器能同时处理的请求数，超过时延迟按比例增加，超过两倍时返回 503；为 0 时不限制
+            shared: 每个课程根目录下内容与其它课程完全相同的文件数（如重复使用的讲义）
+            stalls: 停顿的响应所占的比例：目录页面在发送前、文件在发送一半后停顿 stallTime 秒，模拟卡住的连接
+        """
+        self.courses = courses
+        self.depth = depth
+        self.folders = folders
+        self.files = files
+        self.fileSize = fileSize
+        self.videos = videos
+        self.videoSize = videoSize
+        self.students = students
+        self.homework = homework
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.contentApi = contentApi
+        self.requireLogin = requireLogin
+        self.capacity = capacity
+        self.shared = shared
+        self.stalls = stalls
+        self.stallTime = stallTime
+
+    def toDict(self):
+        return dict(self.__dict__)
+
+
+class MockSite:
+    """根据配置生成的全部模拟数据"""
+
+    def __init__(self, config):
+        self.config = config
+        self.courses = []
+        # 目录路径 -> (子目录名列表, 文件名列表)，文件路径 -> 大小
+        self.folders = {}
+        self.files = {}
+        # 内容相同的文件路径 -> 决定内容和 ETag 的键
+        self.contentKeys = {}
+        # siteId -> 作业数
+        self.homework = {}
+        self.lock = threading.Lock()
+        for i in range(config.courses):
+            siteId = str(100000 + i)
+            self.homework[siteId] = config.homework
+            # 课程名与 UCAS.getCoursesOfCurrentTerm 中的学期格式一致，最后一个课程属于上一学年
+            year = time.localtime().tm_year % 100 - (1 if i == config.courses - 1 and i > 0 else 0)
+            season = '秋季' if time.localtime().tm_mon >= 9 or time.localtime().tm_mon <= 2 else '春季'
+            self.courses.append((siteId, '模拟课程%02d(%d-%d%s)' % (i, year, year + 1, season)))
+            root = '/access/content/group/%s/' % siteId
+            self.__makeFolder(root, 0)
+            for j in range(config.videos):
+                self.files[root + '课程视频%02d.mp4' % j] = config.videoSize
+                self.folders[root][1].append('课程视频%02d.mp4' % j)
+            for j in range(config.shared):
+                name = '公共资料%02d.pdf' % j
+                self.files[root + name] = config.fileSize
+                self.folders[root][1].append(name)
+                self.contentKeys[root + name] = 'shared/' + name
+
+    def __makeFolder(self, path, level):
+        subFolders = ['第%d-%d章' % (level, j) for j in range(self.config.folders)] \
+            if level < self.config.depth else []
+        files = ['讲义%d-%02d.pdf' % (level, j) for j in range(self.config.files)]
+        self.folders[path] = (subFolders, files)
+        for f in files:
+            self.files[path + f] = self.config.fileSize
+        for folder in subFolders:
+            self.__makeFolder(path + folder + '/', level + 1)
+
+    def addFile(self, siteId):
+        """在课程根目录下增加一个文件，模拟老师上传了新课件，返回文件路径"""
+        root = '/access/content/group/%s/' % siteId
+        with self.lock:
+            files = self.folders[root][1]
+            path = root + '新课件%02d.pdf' % len(files)
+            self.files[path] = self.config.fileSize
+            files.append(path[len(root):])
+        return path
+
+    def addHomework(self, siteId):
+        with self.lock:
+            self.homework[siteId] += 1
+            return self.homework[siteId]
+
+    def contentKey(self, path):
+        return self.contentKeys.get(path, path)
+
+    @staticmethod
+    def etag(path, size):
+        return '"%s-%d"' % (hashlib.md5(path.encode('utf8')).hexdigest()[:16], size)
+
+    @staticmethod
+    def block(path):
+        """文件内容由 64KB 的块重复组成，不需要把文件保存在内存中"""
+        seed = hashlib.sha256(path.encode('utf8')).digest()
+        return seed * (65536 // len(seed))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.bytesSent = 0
+        self.peakInFlight = self.inFlight
+
+    def enter(self):
+        """开始处理一个请求，返回正在处理的请求数"""
+        with self.lock:
+            self.inFlight += 1
+            self.peakInFlight = max(self.peakInFlight, self.inFlight)
+            return self.inFlight
+
+    def leave(self):
+        with self.lock:
+            self.inFlight -= 1
+
+    def add(self, kind, nBytes=0):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytesSent += nBytes
+
+    def addBytes(self, nBytes):
+        with self.lock:
+            self.bytesSent += nBytes
+
+    def toDict(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'total': sum(self.requests.values()),
+                    'bytesSent': self.bytesSent, 'peakInFlight': self.peakInFlight}
+
+
+def page(title, body):
+    return ('<!DOCTYPE html>\n<html><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />'
+            '<title>%s</title></head><body>%s</body></html>' % (title, body)).encode('utf8')
+
+
+def quote(s):
+    return urllib.parse.quote(s)
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    site = None
+    stats = None
+    sessions = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf8'))
+        self.handle_request(True, form)
+
+    def handle_request(self, withBody, form=None):
+        url = urllib.parse.urlsplit(self.path)
+        host = url.netloc or self.headers.get('Host', '')
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if path == '/__stats':
+            return self.send(json.dumps(self.stats.toDict()).encode('utf8'), withBody, 'application/json')
+        if path == '/__reset':
+            self.send(b'ok', withBody)
+            return self.stats.reset()
+        if path == '/__expire':
+            self.sessions['SAKAI'].clear()
+            if 'sep' in query:
+                self.sessions['SEP'].clear()
+            return self.send(b'ok', withBody)
+        if path == '/__add':
+            siteId = query['site'][0]
+            added = self.site.addHomework(siteId) if 'homework' in query else self.site.addFile(siteId)
+            return self.send(json.dumps({'added': added}).encode('utf8'), withBody, 'application/json')
+
+        inFlight = self.stats.enter()
+        try:
+            self.handle_resource(host, path, query, withBody, form, inFlight)
+        finally:
+            self.stats.leave()
+
+    def handle_resource(self, host, path, query, withBody, form, inFlight):
+        config = self.site.config
+        if config.capacity and inFlight > config.capacity * 2:
+            self.stats.add('overloaded')
+            return self.send(page('503', 'Service Unavailable'), withBody, status=503)
+        if config.latency:
+            time.sleep(config.latency * max(1, inFlight / config.capacity if config.capacity else 1))
+        try:
+            if host == SepHost:
+                return self.handle_sep(path, withBody, form)
+            if config.requireLogin and path != '/portal/plogin' and not self.hasSession('SAKAI'):
+                self.stats.add('loginRedirect')
+                return self.send(b'', withBody, status=302, headers={'Location': 'http://%s/' % SepHost})
+            if path.startswith('/access/content/group/'):
+                return self.handle_content(path, withBody)
+            if path.startswith('/access/content/attachment/'):
+                return self.handle_attachment(path, withBody)
+            if path.startswith('/direct/content/site/'):
+                return self.handle_content_api(path, withBody)
+            return self.handle_portal(path, query, withBody)
+        except KeyError:
+            self.stats.add('notFound')
+            self.send(page('404', 'Not Found'), withBody, status=404)
+
+    def hasSession(self, name):
+        cookies = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+        return name in cookies and cookies[name].value in self.sessions[name]
+
+    def newSession(self, name):
+        """创建会话，返回设置 Cookie 的响应头"""
+        token = '%s%d' % (name.lower(), len(self.sessions[name]))
+        self.sessions[name].add(token)
+        return {'Set-Cookie': '%s=%s; Path=/' % (name, token)}
+
+    def send(self, data, withBody, contentType='text/html; charset=UTF-8', status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if withBody:
+            self.wfile.write(data)
+            self.stats.addBytes(len(data))
+
+    # ******************** SEP ********************
+
+    def handle_sep(self, path, withBody, form):
+        self.stats.add('sep')
+        if path == '/changePic':
+            return self.send(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64, withBody, 'image/png')
+        if path == '/slogin':
+            if form and form.get('pwd', [''])[0] == 'wrong':
+                return self.send(page('登录', '<div class="alert alert-error">密码错误</div>'), withBody)
+            return self.send(page('首页', '<div class="alert alert-success">登录成功</div>'), withBody,
+                             headers=self.newSession('SEP'))
+        if self.site.config.requireLogin and path.startswith('/portal/') and not self.hasSession('SEP'):
+            return self.send(b'', withBody, status=302, headers={'Location': 'http://%s/' % SepHost})
+        if path == '/portal/site/16/801':
+            return self.send(page('课程网站', '<a href="http://%s/portal/plogin?Identity=mock">进入</a>' % CourseHost),
+                             withBody)
+        return self.send(page('SEP', '<form action="/slogin"></form>'), withBody)
+
+    # ******************** 课程网站 ********************
+
+    def handle_portal(self, path, query, withBody):
+        self.stats.add('portal')
+        if path == '/portal/plogin':
+            return self.send(page('课程网站', '<frameset><frame title="mainFrame" src="/portal/main" /></frameset>'),
+                             withBody, headers=self.newSession('SAKAI'))
+        if path == '/portal/main':
+            links = ''.join('<li><a class="icon-sakai-%s" href="http://%s/portal/page/%s">%s</a></li>' %
+                            (name, CourseHost, name, title)
+                            for name, title in (('mycourses', '我的课程'), ('workspace', '工作空间')))
+            body = '<ul id="toolMenu">%s</ul><iframe title="我的空间信息 " src="/portal/tool/myinfo"></iframe>' % links
+            return self.send(page('我的工作空间', body), withBody)
+        if path.startswith('/portal/page/'):
+            return self.send(page('工具', '<iframe src="http://%s/portal/tool/%s"></iframe>' %
+                                  (CourseHost, path.split('/')[-1])), withBody)
+        if path == '/portal/tool/myinfo':
+            return self.send(page('我的信息', '当前登录用户：模拟用户(201528013329001)'), withBody)
+        if path == '/portal/tool/workspace':
+            return self.send(page('工作空间', ''), withBody)
+        if path == '/portal/tool/mycourses':
+            rows = ''.join('<tr><td><a href="http://%s/portal/site/%s">%s</a></td></tr>' % (CourseHost, siteId, name)
+                           for siteId, name in self.site.courses)
+            return self.send(page('我的课程', '<table>%s</table>' % rows), withBody)
+
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['portal', 'site'] and len(parts) == 3:
+            siteId = parts[2]
+            self.courseName(siteId)
+            links = ''.join('<li><a class="icon-sakai-tool" href="http://%s/portal/site/%s/page/%d">%s</a></li>' %
+                            (CourseHost, siteId, i, title) for i, title in enumerate(Tools))
+            return self.send(page(siteId, '<ul id="toolMenu">%s</ul>' % links), withBody)
+        if parts[:2] == ['portal', 'site'] and len(parts) == 5:
+            return self.send(page('工具', '<iframe src="http://%s/portal/tool/%s/%s"></iframe>' %
+                                  (CourseHost, parts[2], parts[4])), withBody)
+        if parts[:2] == ['portal', 'tool'] and len(parts) >= 4:
+            siteId, tool = parts[2], Tools[int(parts[3])]
+            self.courseName(siteId)
+            if tool == '应用统计':
+                return self.send(self.roster(siteId), withBody)
+            if tool == '课堂作业' and len(parts) == 5:
+                return self.send(self.homeworkDetail(siteId, int(parts[4])), withBody)
+            if tool == '课堂作业':
+                return self.send(self.homeworkList(siteId), withBody)
+            return self.send(page(tool, '<p>%s</p>' % tool), withBody)
+        raise KeyError(path)
+
+    def courseName(self, siteId):
+        return dict(self.site.courses)[siteId]
+
+    def roster(self, siteId):
+        rows = ['<tr><th>序号</th><th>学号</th><th>姓名</th><th>单位</th></tr>']
+        for i in range(self.site.config.students):
+            # 学生分布在不同课程中，部分学生同时选了多门课程
+            studentId = 201528013329000 + (int(siteId) * 7 + i * 3) % (self.site.config.students * 2)
+            rows.append('<tr><td>%d</td><td>%d</td><td>学生%d</td><td>计算机学院</td></tr>' %
+                        (i + 1, studentId, studentId % 10000))
+        return page('应用统计', '<table><tr><td>统计</td></tr></table><table>%s</table>' % ''.join(rows))
+
+    def homeworkList(self, siteId):
+        rows = ['<tr><th>选择</th><th>作业标题</th><th>状态</th><th>开始</th><th>截止</th></tr>']
+        for i in range(self.site.homework[siteId]):
+            rows.append('<tr><td></td><td><a href="http://%s/portal/tool/%s/1/%d">第%d次作业</a></td><td>%s</td>'
+                        '<td>2016-9-%d</td><td>2016-10-%d</td></tr>' %
+                        (CourseHost, siteId, i, i + 1, '尚未提交' if i % 2 else '已提交', i + 1, i + 1))
+        return page('课堂作业', '<table>%s</table>' % ''.join(rows))
+
+    def homeworkDetail(self, siteId, index):
+        attachments = ''.join('<li><a href="http://%s/access/content/attachment/%s/%d/%s">%s</a></li>' %
+                              (CourseHost, siteId, index, quote(name), name)
+                              for name in self.attachmentNames(index))
+        return page('作业', '<table><tr><td>第%d次作业</td></tr></table><div class="textPanel">请完成习题。</div>'
+                    '<h4>作业的附加资源</h4><ul class="attachList">%s</ul>' % (index + 1, attachments))
+
+    @staticmethod
+    def attachmentNames(index):
+        return ['作业%d说明.pdf' % (index + 1), '作业%d数据.zip' % (index + 1)]
+
+    # ******************** 课程资源 ********************
+
+    def stall(self):
+        """按配置的比例决定这个响应是否停顿"""
+        if self.site.config.stalls and random.random() < self.site.config.stalls:
+            self.stats.add('stalled')
+            return True
+        return False
+
+    def handle_content(self, path, withBody):
+        if path.endswith('/'):
+            if self.stall():
+                time.sleep(self.site.config.stallTime)
+            with self.site.lock:
+                subFolders, files = self.site.folders[path]
+                rows = ['<tr><td><a href="../">上一级目录</a></td></tr>']
+                rows += ['<tr><td><a href="%s/">%s</a></td></tr>' % (quote(f), f) for f in subFolders]
+                rows += ['<tr><td><a href="%s">%s</a></td></tr>' % (quote(f), f) for f in files]
+            data = page(path, '<table>%s</table>' % ''.join(rows))
+            etag = '"%s"' % hashlib.md5(data).hexdigest()[:16]
+            if self.headers.get('If-None-Match') == etag:
+                self.stats.add('listingNotModified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.stats.add('listing')
+            return self.send(data, withBody, headers={'ETag': etag})
+        self.sendFile(path, self.site.files[path], withBody)
+
+    def handle_attachment(self, path, withBody):
+        parts = path.strip('/').split('/')
+        if parts[-1] not in self.attachmentNames(int(parts[-2])):
+            raise KeyError(path)
+        self.sendFile(path, self.site.config.fileSize, withBody)
+
+    def handle_content_api(self, path, withBody):
+        if not self.site.config.contentApi:
+            raise KeyError(path)
+        self.stats.add('contentApi')
+        siteId = path.split('/')[-1][:-len('.json')]
+        prefix = '/access/content/group/%s/' % siteId
+        with self.site.lock:
+            collection = [{'url': 'http://%s%s' % (CourseHost, quote(p)), 'size': size,
+                           'modifiedDate': SakaiModifiedDate, 'type': 'file'}
+                          for p, size in self.site.files.items() if p.startswith(prefix)]
+        if not collection:
+            raise KeyError(path)
+        self.send(json.dumps({'content_collection': collection}).encode('utf8'), withBody, 'application/json')
+
+    def sendFile(self, path, size, withBody):
+        self.stats.add('file' if withBody else 'head')
+        etag = MockSite.etag(self.site.contentKey(path), size)
+        if self.headers.get('If-None-Match') == etag or self.headers.get('If-Modified-Since') == LastModified:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start, end, status = 0, size - 1, 200
+        rangeHeader = self.headers.get('Range')
+        ifRange = self.headers.get('If-Range')
+        if rangeHeader and (not ifRange or ifRange in (etag, LastModified)):
+            first, last = rangeHeader.split('=', 1)[1].split('-')
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', LastModified)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if not withBody:
+            return
+
+        block = MockSite.block(self.site.contentKey(path))
+        bandwidth = self.site.config.bandwidth
+        position = start
+        startTime = time.time()
+        stallAt = (start + end) // 2 if self.stall() else None
+        while position <= end:
+            if stallAt is not None and position >= stallAt:
+                # 发送一半后不再发送数据，客户端超时断开或者 stallTime 后关闭连接
+                time.sleep(self.site.config.stallTime)
+                self.close_connection = True
+                return
+            offset = position % len(block)
+            chunk = block[offset:offset + min(len(block) - offset, end - position + 1)]
+            self.wfile.write(chunk)
+            self.stats.addBytes(len(chunk))
+            position += len(chunk)
+            if bandwidth:
+                delay = (position - start) / bandwidth - (time.time() - startTime)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class MockServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # 客户端提前关闭连接（如分段下载的第一段）是正常的
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def createServer(config, port=0):
+    """创建服务器，返回的服务器还没有开始运行"""
+    handler = type('Handler', (MockHandler,), {'site': MockSite(config), 'stats': Stats(),
+                                              'sessions': {'SAKAI': set(), 'SEP': set()}})
+    return MockServer(('127.0.0.1', port), handler)
+
+
+def startServer(config, port=0):
+    """在后台线程中运行服务器，返回 (server, proxyUrl)"""
+    server = createServer(config, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def runServer(configDict, port, conn):
+    """在子进程中运行服务器，通过 conn 把端口号告诉父进程"""
+    server = createServer(MockConfig(**configDict), port)
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--port', dest='port', type='int', default=8080, help='监听端口，默认是 %default')
+    parser.add_option('--courses', dest='courses', type='int', default=4, help='课程数，默认是 %default')
+    parser.add_option('--depth', dest='depth', type='int', default=2, help='目录深度，默认是 %default')
+    parser.add_option('--folders', dest='folders', type='int', default=2, help='每个目录下的子目录数，默认是 %default')
+    parser.add_option('--files', dest='files', type='int', default=10, help='每个目录下的文件数，默认是 %default')
+    parser.add_option('--file-size', dest='fileSize', type='int', default=200, help='文件大小（KB），默认是 %default')
+    parser.add_option('--latency', dest='latency', type='float', default=20, help='请求延迟（毫秒），默认是 %default')
+    parser.add_option('--require-login', dest='requireLogin', action='store_true', default=False,
+                      help='课程网站检查会话 Cookie，没有时重定向到 SEP')
+    opts, args = parser.parse_args()
+
+    config = MockConfig(courses=opts.courses, depth=opts.depth, folders=opts.folders, files=opts.files,
+                        fileSize=opts.fileSize * 1024, latency=opts.latency / 1000, requireLogin=opts.requireLogin)
+    server = createServer(config, opts.port)
+    print('代理地址: http://127.0.0.1:%d' % server.server_address[1])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+
+"""页面解析的微基准测试
+
+用 fixtures 目录中保存的 Sakai 页面比较原来的 BeautifulSoup 解析方式和 UCASCourse 中直接使用 lxml 的解析方式，
+先确认两者的结果相同，再比较耗时。需要额外安装 BeautifulSoup。
+
+usage: python ParseBenchmark.py [次数]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import UCASCourse
+
+BeautifulSoupDefaultParser = 'lxml'
+FixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def readFixture(name):
+    with open(os.path.join(FixtureDir, name), encoding='utf8') as fh:
+        return fh.read()
+
+
+# ******************** 原来的 BeautifulSoup 解析方式 ********************
+
+
+def soupListing(html):
+    table = BeautifulSoup(html, BeautifulSoupDefaultParser).table
+    files = [UCASCourse.LinkInfo(name=e.text.strip(), url=e['href']) for e in table('a')
+             if not e['href'].endswith('/')]
+    folders = [UCASCourse.LinkInfo(name=e.text.strip(), url=e['href']) for e in table('a')
+               if e['href'].endswith('/')]
+    folders = [x for x in folders if not x.url.startswith("..")]
+    return files, folders
+
+
+def soupStudents(html):
+    table = BeautifulSoup(html, BeautifulSoupDefaultParser)('table')[1]
+    rList = []
+    for row in table('tr'):
+        tds = row('td')
+        if len(tds):
+            rList.append((tds[1].text.strip(), tds[2].text.strip()))
+    return rList
+
+
+def soupToolPage(html):
+    # 原来工具栏和"我的空间信息"各自解析一次页面
+    aList = BeautifulSoup(html, BeautifulSoupDefaultParser)('a', class_=re.compile('icon-sakai-.+'))
+    tools = [(entry.text.strip(), entry['href']) for entry in aList]
+    info = BeautifulSoup(html, BeautifulSoupDefaultParser).find('iframe', title='我的空间信息 ')['src']
+    return tools, info
+
+
+def soupHomeworkList(html):
+    table = BeautifulSoup(html, BeautifulSoupDefaultParser).table
+    rList = []
+    for row in table('tr'):
+        tds = row('td')
+        if len(tds):
+            rList.append((tds[1].a['href'], tds[2].text.strip(), tds[3].text.strip(), tds[4].text.strip()))
+    return rList
+
+
+def soupHomeworkDetail(html):
+    detail = BeautifulSoup(html, BeautifulSoupDefaultParser)
+    name = detail.find('table').td.text.strip()
+    content = detail.find('div', class_='textPanel')
+    content = content and content.text.strip()
+    attachments = detail.find(class_='attachList') if '作业的附加资源' in detail.text else None
+    attachments = attachments and [UCASCourse.LinkInfo(name=e.text.strip(), url=e['href'])
+                                   for e in attachments('a')]
+    return name, content, attachments
+
+
+# ******************** lxml 解析方式 ********************
+
+
+def lxmlToolPage(html):
+    doc = UCASCourse.parseHtml(html)
+    tools = [tuple(x) for x in UCASCourse.parseToolLinks(doc)]
+    info = UCASCourse.findFirst(doc, '//iframe[@title="我的空间信息 "]').attrib['src']
+    return tools, info
+
+
+Cases = [
+    ('课件目录', 'listing.html', soupListing, UCASCourse.parseListing),
+    ('应用统计', 'roster.html', soupStudents, UCASCourse.parseStudents),
+    ('工具页', 'toolpage.html', soupToolPage, lxmlToolPage),
+    ('作业列表', 'homework_list.html', soupHomeworkList, UCASCourse.parseHomeworkList),
+    ('作业详情', 'homework_detail.html', soupHomeworkDetail, UCASCourse.parseHomeworkDetail),
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('{:<8}{:>10}{:>14}{:>12}{:>10}'.format('页面', '大小(KB)', 'soup(ms)', 'lxml(ms)', '加速比'))
+    for name, fixture, soupParse, lxmlParse in Cases:
+        html = readFixture(fixture)
+        if soupParse(html) != lxmlParse(html):
+            raise Exception('%s 的解析结果不一致' % name)
+        soupTime = timeit.timeit(lambda: soupParse(html), number=number) / number * 1000
+        lxmlTime = timeit.timeit(lambda: lxmlParse(html), number=number) / number * 1000
+        print('{:<8}{:>10.1f}{:>14.2f}{:>12.2f}{:>10.1f}'.format(name, len(html.encode('utf8')) / 1024,
+                                                              soupTime, lxmlTime, soupTime / lxmlTime))
+
+
+if __name__ == '__main__':
+    main()
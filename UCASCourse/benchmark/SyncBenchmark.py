@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+
+"""同步性能的离线基准测试
+
+在子进程中启动 MockSakaiServer，让 UCASCourse 通过它访问模拟的 SEP 和课程网站，
+依次测量获取课程列表、抓取课件目录、比较本地文件、下载、再次同步（增量）以及监视模式检查各阶段的
+耗时、请求数、传输的字节数和内存峰值。不需要 UCAS 账号，也不需要联网。
+
+usage: python SyncBenchmark.py [options]
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import UCASCourse
+import MockSakaiServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Benchmark:
+
+    def __init__(self, proxyUrl, syncDir, threads=4, segmentThreshold=0, traceMemory=False, maxConcurrency=0,
+                 timeout=30, hedgeDelay=0):
+        self.proxyUrl = proxyUrl
+        self.syncDir = syncDir
+        self.threads = threads
+        self.segmentThreshold = segmentThreshold
+        self.traceMemory = traceMemory
+        self.results = []
+        # 和 UCASCourse.main() 一样，开启并发控制时抓取线程数是并发上限
+        self.concurrency = UCASCourse.AdaptiveConcurrency(threads, 1, maxConcurrency) if maxConcurrency else None
+        self.crawlThreads = self.concurrency.maximum if self.concurrency else threads
+        self.ucas = UCASCourse.UCAS(poolSize=max(self.crawlThreads, threads) + 4, concurrency=self.concurrency,
+                                    timeout=(min(10, timeout), timeout), hedgeDelay=hedgeDelay)
+        self.useMock(self.ucas.session)
+
+    def useMock(self, session):
+        session.trust_env = False
+        session.proxies = {'http': self.proxyUrl}
+
+    def serverStats(self):
+        return requests.get('http://mock.local/__stats', proxies={'http': self.proxyUrl}).json()
+
+    def resetServerStats(self):
+        requests.get('http://mock.local/__reset', proxies={'http': self.proxyUrl})
+
+    def phase(self, name, func):
+        """运行一个阶段并记录结果"""
+        self.resetServerStats()
+        if self.traceMemory:
+            tracemalloc.start()
+        startTime = time.perf_counter()
+        startCpu = time.process_time()
+        result = func()
+        wallTime = time.perf_counter() - startTime
+        cpuTime = time.process_time() - startCpu
+        if self.traceMemory:
+            peakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        elif resource:
+            # ru_maxrss 是整个进程的峰值，在 Linux 上以 KB 为单位
+            peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        else:
+            peakMemory = 0
+        stats = self.serverStats()
+        self.results.append({'phase': name, 'wallTime': wallTime, 'cpuTime': cpuTime,
+                             'requests': stats['total'], 'requestsByKind': stats['requests'],
+                             'bytes': stats['bytesSent'], 'peakMemory': peakMemory})
+        return result
+
+    def crawl(self, courses, manifest, metadata):
+        crawler = UCASCourse.ResourceCrawler(self.ucas.session, self.crawlThreads, self.crawlThreads,
+                                             manifest=manifest, metadata=metadata)
+        return crawler.crawl([(c.resourceUrl, c.name) for c in courses])
+
+    @staticmethod
+    def diff(courses, fileLists, syncDir, manifest):
+        rList = [(c.name, c.getSyncResourceList(syncDir, None, fileList, manifest))
+                 for c, fileList in zip(courses, fileLists)]
+        manifest.save()
+        return [m for m in rList if m[1]]
+
+    def run(self):
+        courses = self.phase('课程列表', lambda: self.ucas.courses)
+
+        manifest = UCASCourse.SyncManifest(self.syncDir)
+        fileLists = self.phase('抓取目录', lambda: self.crawl(courses, manifest, self.ucas.metadata))
+        downloadList = self.phase('比较文件', lambda: self.diff(courses, fileLists, self.syncDir, manifest))
+        self.phase('下载', lambda: UCASCourse.downloadAll(self.ucas.session, downloadList, None, self.threads,
+                                                         manifest, self.segmentThreshold))
+
+        # 再次同步相当于重新运行一次程序，批量元数据和清单都重新读取
+        manifest = UCASCourse.SyncManifest(self.syncDir)
+        metadata = UCASCourse.MetadataSource(self.ucas.session)
+        fileLists = self.phase('增量抓取', lambda: self.crawl(courses, manifest, metadata))
+        downloadList = self.phase('增量比较', lambda: self.diff(courses, fileLists, self.syncDir, manifest))
+        if downloadList:
+            raise Exception('增量同步时仍有 %d 个课程需要下载' % len(downloadList))
+
+        # 监视模式第一次检查时建立目录页面的缓存，之后的检查只发送条件请求
+        watcher = UCASCourse.CourseWatcher(self.ucas, courses, self.syncDir, manifest=manifest,
+                                           threadCount=self.crawlThreads)
+        self.phase('监视首次', watcher.poll)
+        self.phase('监视检查', watcher.poll)
+        return self.results
+
+
+def printResults(results):
+    print('{:<8}{:>10}{:>10}{:>10}{:>12}{:>12}{:>12}{:>12}'.format('阶段', '耗时(s)', 'CPU(s)', '请求数', '传输',
+                                                                   '速度', 'CPU(s)/GB', '内存峰值'))
+    for r in results:
+        speed = UCASCourse.formatSize(r['bytes'] / r['wallTime']) + '/s' if r['bytes'] else '-'
+        # 只有传输了较多数据的阶段（下载）每 GB 的 CPU 时间才有意义
+        cpuPerGB = '%.2f' % (r['cpuTime'] / r['bytes'] * 2 ** 30) if r['bytes'] > 2 ** 20 else '-'
+        print('{:<8}{:>10.2f}{:>10.2f}{:>10}{:>12}{:>12}{:>12}{:>12}'.format(
+            r['phase'], r['wallTime'], r['cpuTime'], r['requests'], UCASCourse.formatSize(r['bytes']), speed,
+            cpuPerGB, UCASCourse.formatSize(r['peakMemory'])))
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--courses', dest='courses', type='int', default=4, help='课程数，默认是 %default')
+    parser.add_option('--depth', dest='depth', type='int', default=2, help='目录深度，默认是 %default')
+    parser.add_option('--folders', dest='folders', type='int', default=2, help='每个目录下的子目录数，默认是 %default')
+    parser.add_option('--files', dest='files', type='int', default=10, help='每个目录下的文件数，默认是 %default')
+    parser.add_option('--file-size', dest='fileSize', type='int', default=200, help='文件大小（KB），默认是 %default')
+    parser.add_option('--videos', dest='videos', type='int', default=0, help='每个课程的大文件数，默认是 %default')
+    parser.add_option('--video-size', dest='videoSize', type='int', default=50,
+                      help='大文件大小（MB），默认是 %default')
+    parser.add_option('--latency', dest='latency', type='float', default=20, help='请求延迟（毫秒），默认是 %default')
+    parser.add_option('--bandwidth', dest='bandwidth', type='int', default=0,
+                      help='每个连接的带宽（KB/s），为 0 时不限制，默认是 %default')
+    parser.add_option('--no-content-api', dest='contentApi', action='store_false', default=True,
+                      help='不提供批量元数据接口，所有文件都需要 HEAD 请求')
+    parser.add_option('--capacity', dest='capacity', type='int', default=0,
+                      help='模拟服务器能同时处理的请求数，为 0 时不限制，默认是 %default')
+    parser.add_option('--stalls', dest='stalls', type='float', default=0,
+                      help='停顿的目录页面和文件所占的比例，默认是 %default')
+    parser.add_option('--stall-time', dest='stallTime', type='float', default=60,
+                      help='停顿的时间（秒），默认是 %default')
+    parser.add_option('-t', '--threads', dest='threads', type='int', default=4, help='并发数，默认是 %default')
+    parser.add_option('--max-concurrency', dest='maxConcurrency', type='int', default=0,
+                      help='自动调整抓取并发数的上限，为 0 时固定使用 -t 指定的数目，默认是 %default')
+    parser.add_option('--timeout', dest='timeout', type='float', default=30,
+                      help='请求超时（秒），默认是 %default')
+    parser.add_option('--hedge-delay', dest='hedgeDelay', type='float', default=0,
+                      help='目录页面的对冲请求至少等待的时间（秒），为 0 时不发送，默认是 %default')
+    parser.add_option('--segment-threshold', dest='segmentThreshold', type='int', default=0,
+                      help='分段下载的阈值（MB），为 0 时不分段，默认是 %default')
+    parser.add_option('--trace-memory', dest='traceMemory', action='store_true', default=False,
+                      help='用 tracemalloc 统计每个阶段的内存峰值（会降低速度）')
+    parser.add_option('--json', dest='json', default=None, help='把结果保存为 JSON 文件，便于比较不同版本')
+    opts, args = parser.parse_args()
+
+    config = MockSakaiServer.MockConfig(courses=opts.courses, depth=opts.depth, folders=opts.folders,
+                                        files=opts.files, fileSize=opts.fileSize * 1024, videos=opts.videos,
+                                        videoSize=opts.videoSize * 1024 * 1024, latency=opts.latency / 1000,
+                                        bandwidth=opts.bandwidth * 1024, contentApi=opts.contentApi,
+                                        capacity=opts.capacity, stalls=opts.stalls, stallTime=opts.stallTime)
+    parentConn, childConn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=MockSakaiServer.runServer, args=(config.toDict(), 0, childConn),
+                                     daemon=True)
+    server.start()
+    proxyUrl = 'http://127.0.0.1:%d' % parentConn.recv()
+
+    syncDir = tempfile.mkdtemp(prefix='ucas-bench-')
+    try:
+        benchmark = Benchmark(proxyUrl, syncDir, opts.threads, opts.segmentThreshold * 1024 * 1024,
+                              opts.traceMemory, opts.maxConcurrency, opts.timeout, opts.hedgeDelay)
+        results = benchmark.run()
+    finally:
+        shutil.rmtree(syncDir, ignore_errors=True)
+        server.terminate()
+
+    printResults(results)
+    if benchmark.concurrency:
+        print('并发控制: %s' % benchmark.concurrency.stats)
+    if benchmark.ucas.session.hedger:
+        print('对冲请求: %s' % benchmark.ucas.session.hedger.stats)
+    if opts.json:
+        with open(opts.json, 'w', encoding='utf8') as fh:
+            json.dump({'config': config.toDict(), 'threads': opts.threads, 'maxConcurrency': opts.maxConcurrency,
+                       'timeout': opts.timeout, 'hedgeDelay': opts.hedgeDelay, 'results': results}, fh, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()